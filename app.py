@@ -1,28 +1,34 @@
 #%% Importing variables
 
-from flask import Flask, request, render_template, redirect, url_for
-import fitz  # PyMuPDF
-import pandas as pd
-import io
-import sys
+from flask import Flask, request, render_template, redirect, url_for, jsonify, Response, stream_with_context
+import numpy as np
 import os
+import re
+import random
+import threading
+import contextvars
+import uuid
+import sqlite3
+import hashlib
+import json
+import time
+import atexit
+import contextlib
+import cProfile
+import multiprocessing
+import shutil
+import tempfile
+from collections import Counter, OrderedDict, deque
+from collections.abc import Sequence
+from itertools import islice, zip_longest
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 import dotenv
-import openai
-import azure.identity
 
-from azure.search.documents import SearchClient
-from azure.search.documents.indexes import SearchIndexClient
-from azure.core.credentials import AzureKeyCredential
-from azure.search.documents.models import VectorizedQuery
-
-from langchain_openai import AzureChatOpenAI, AzureOpenAIEmbeddings
-from langchain_community.document_loaders import PyMuPDFLoader  # PyMuPDF
-from langchain_community.vectorstores.azuresearch import AzureSearch
+# pandas, PyMuPDF, azure and langchain are imported on first use so the app starts serving quickly
 
 #%% Load environment variables
 dotenv.load_dotenv()
-azure_credential = azure.identity.AzureDeveloperCliCredential(tenant_id=os.getenv("AZURE_TENANT_ID"))
 
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
@@ -36,162 +42,1394 @@ AZURE_MODEL_NAME = os.getenv("AZURE_MODEL_NAME")
 AZURE_SEARCH_ENDPOINT = os.getenv("AZURE_SEARCH_ENDPOINT")
 AZURE_SEARCH_KEY = os.getenv("AZURE_SEARCH_KEY")
 AZURE_SEARCH_INDEX = "index_srch_docs_rbgenai_003"
+AZURE_SEARCH_BATCH_SIZE = 1000  # Max documents per indexing request
+LLM_TEMPERATURE = 0
 AZURE_TENANT_ID = os.getenv("AZURE_TENANT_ID")
 AZURE_SUBSCRIPTION_ID = os.getenv("AZURE_SUBSCRIPTION_ID")
 os.environ["LANGCHAIN_TRACING_V2"] = "false"
 
+GENAI_MAX_WORKERS = int(os.getenv("GENAI_MAX_WORKERS", "8"))  # 1 = sequential
+GENAI_RETRIEVER = os.getenv("GENAI_RETRIEVER", "azure")  # "azure" or "local"
+GENAI_HYBRID_SEARCH = os.getenv("GENAI_HYBRID_SEARCH", "true").lower() == "true"  # BM25 + vector for the local index
+GENAI_RETRIEVAL_K = int(os.getenv("GENAI_RETRIEVAL_K", "20"))  # Chunks retrieved per query
+GENAI_CONTEXT_TOKENS = int(os.getenv("GENAI_CONTEXT_TOKENS", "3000"))  # Token budget for the excerpts in one prompt
+GENAI_PARSE_WORKERS = int(os.getenv("GENAI_PARSE_WORKERS", str(min(4, os.cpu_count() or 1))))  # Processes extracting page text, 1 = in-process
+GENAI_PARSE_PAGES_PER_TASK = int(os.getenv("GENAI_PARSE_PAGES_PER_TASK", "25"))
+GENAI_INGEST_BATCH_SIZE = int(os.getenv("GENAI_INGEST_BATCH_SIZE", "128"))  # Chunks embedded and indexed per request
+GENAI_HEADER_SAMPLE_PAGES = int(os.getenv("GENAI_HEADER_SAMPLE_PAGES", "50"))  # Pages sampled to detect repeated headers and footers
+GENAI_SPOOL_DIR = os.getenv("GENAI_SPOOL_DIR", tempfile.gettempdir())  # Uploaded PDFs and per-award document stores
+GENAI_EXTRACTOR_MIN_CONFIDENCE = float(os.getenv("GENAI_EXTRACTOR_MIN_CONFIDENCE", "0.8"))  # Below this the field goes to the LLM
+GENAI_STRUCTURED_OUTPUT = os.getenv("GENAI_STRUCTURED_OUTPUT", "false").lower() == "true"  # Answer and source in one JSON completion
+GENAI_BATCH_FIELDS = os.getenv("GENAI_BATCH_FIELDS", "false").lower() == "true"  # One structured prompt per FIELD_GROUPS entry
+GENAI_JOB_WORKERS = int(os.getenv("GENAI_JOB_WORKERS", "2"))  # Awards processed at once by the web app
+GENAI_MAX_STORED_JOBS = int(os.getenv("GENAI_MAX_STORED_JOBS", "50"))  # Finished jobs kept for /jobs and results
+GENAI_MAX_QUEUED_JOBS = int(os.getenv("GENAI_MAX_QUEUED_JOBS", "20"))  # Uploads waiting for a job worker before new ones get 503
+GENAI_CACHE_DIR = os.getenv("GENAI_CACHE_DIR", ".genai_cache")
+GENAI_EMBEDDING_CACHE_SIZE = int(os.getenv("GENAI_EMBEDDING_CACHE_SIZE", "500000"))  # Max cached vectors
+GENAI_LLM_CACHE_SIZE = int(os.getenv("GENAI_LLM_CACHE_SIZE", "100000"))  # Max cached completions
+GENAI_LLM_CACHE_TTL = float(os.getenv("GENAI_LLM_CACHE_TTL", str(30 * 24 * 3600)))  # Seconds, 0 = no expiry
+GENAI_WARM_EMBEDDINGS = os.getenv("GENAI_WARM_EMBEDDINGS", "true").lower() == "true"
+# Azure OpenAI quota per deployment, enforced by the request schedulers
+GENAI_LLM_RPM = int(os.getenv("GENAI_LLM_RPM", "300"))
+GENAI_LLM_TPM = int(os.getenv("GENAI_LLM_TPM", "150000"))
+GENAI_LLM_MAX_CONCURRENCY = int(os.getenv("GENAI_LLM_MAX_CONCURRENCY", "16"))
+GENAI_EMBEDDING_RPM = int(os.getenv("GENAI_EMBEDDING_RPM", "300"))
+GENAI_EMBEDDING_TPM = int(os.getenv("GENAI_EMBEDDING_TPM", "350000"))
+GENAI_EMBEDDING_MAX_CONCURRENCY = int(os.getenv("GENAI_EMBEDDING_MAX_CONCURRENCY", "4"))
+GENAI_MAX_RETRIES = int(os.getenv("GENAI_MAX_RETRIES", "6"))  # Per call, on 429s, 5xx responses, timeouts and connection errors
+GENAI_PROFILE_DIR = os.getenv("GENAI_PROFILE_DIR")  # If set, a cProfile dump of each award's processing thread is written here
+GENAI_HTTP_POOL_SIZE = int(os.getenv("GENAI_HTTP_POOL_SIZE", "32"))  # Keep-alive connections per service
+
 LANGCHAIN_ENDPOINT = os.getenv("LANGCHAIN_ENDPOINT")
 LANGCHAIN_API_KEY = os.getenv("LANGCHAIN_API_KEY") 
 
 
 #%%  Create contextual variables
-token_provider = azure.identity.get_bearer_token_provider(azure_credential,
-    "https://cognitiveservices.azure.com/.default")
-openai_client = openai.AzureOpenAI(
-    api_version=OPENAI_API_VERSION,
-    azure_endpoint=AZURE_OPENAI_ENDPOINT,
-    azure_ad_token_provider=token_provider)
-
-llm = AzureChatOpenAI(deployment_name=AZURE_DEPLOYMENT_NAME, model_name=AZURE_MODEL_NAME, temperature=0)
-embedding = AzureOpenAIEmbeddings(model=AZURE_EMBEDDING_MODEL, api_key=OPENAI_API_KEY)
-def get_embedding(text):
-    return embedding.embed_query(text)
-index_client = SearchIndexClient(endpoint=AZURE_SEARCH_ENDPOINT, credential=azure_credential)
 
+class ClientRegistry: # Service clients created on first use and shared across requests and threads
+    def __init__(self):
+        self._factories = {}
+        self._clients = {}
+        self._lock = threading.RLock()
+
+    def register(self, name, factory):
+        self._factories[name] = factory
+
+    def get(self, name):
+        client = self._clients.get(name)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(name)
+                if client is None:
+                    client = self._clients[name] = self._factories[name]()
+        return client
+
+    def override(self, name, client): # Replace a client, e.g. with a local stand-in
+        with self._lock:
+            self._clients[name] = client
+
+    def close(self):
+        with self._lock:
+            for name, client in reversed(list(self._clients.items())):
+                try:
+                    if hasattr(client, "close"):
+                        client.close()
+                    elif hasattr(client, "shutdown"):
+                        client.shutdown(cancel_futures=True)
+                except Exception as e:
+                    print(f"Closing {name} failed: {e}")
+            self._clients.clear()
+
+clients = ClientRegistry()
+atexit.register(clients.close)
+
+def _openai_http():
+    import httpx
+    return httpx.Client(limits=httpx.Limits(max_connections=GENAI_HTTP_POOL_SIZE, max_keepalive_connections=GENAI_HTTP_POOL_SIZE),
+                        timeout=httpx.Timeout(120.0, connect=10.0))
+
+def _llm():
+    from langchain_openai import AzureChatOpenAI
+    # Retries are left to the schedulers below so that 429s are coordinated across calls
+    return AzureChatOpenAI(deployment_name=AZURE_DEPLOYMENT_NAME, model_name=AZURE_MODEL_NAME, temperature=LLM_TEMPERATURE,
+                           max_retries=0, http_client=clients.get("openai_http"))
+
+def _embedding():
+    from langchain_openai import AzureOpenAIEmbeddings
+    return AzureOpenAIEmbeddings(model=AZURE_EMBEDDING_MODEL, api_key=OPENAI_API_KEY, max_retries=0,
+                                 http_client=clients.get("openai_http"))
+
+def _search_transport():
+    import requests
+    from azure.core.pipeline.transport import RequestsTransport
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=GENAI_HTTP_POOL_SIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return RequestsTransport(session=session, session_owner=False)
+
+def _index_client(): # Key auth like the search client, a developer CLI credential would run a subprocess per token
+    from azure.search.documents.indexes import SearchIndexClient
+    from azure.core.credentials import AzureKeyCredential
+    return SearchIndexClient(endpoint=AZURE_SEARCH_ENDPOINT, credential=AzureKeyCredential(AZURE_SEARCH_KEY),
+                             transport=clients.get("search_transport"))
+
+def _search_client():
+    from azure.search.documents import SearchClient
+    from azure.core.credentials import AzureKeyCredential
+    ensure_search_index()
+    return SearchClient(endpoint=AZURE_SEARCH_ENDPOINT, index_name=AZURE_SEARCH_INDEX,
+                        credential=AzureKeyCredential(AZURE_SEARCH_KEY), transport=clients.get("search_transport"))
+
+def _parse_pool(): # Spawned rather than forked, the app has threads running by now
+    return ProcessPoolExecutor(max_workers=GENAI_PARSE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+clients.register("openai_http", _openai_http)
+clients.register("llm", _llm)
+clients.register("embedding", _embedding)
+clients.register("search_transport", _search_transport)
+clients.register("index_client", _index_client)
+clients.register("search_client", _search_client)
+clients.register("parse_pool", _parse_pool)
+
+#%% Instrumentation
+
+class Metrics: # Prometheus-style counters and latency histograms, rendered by /metrics
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+    def __init__(self):
+        self._counters = {}  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> cumulative bucket counts + [sum, count]
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.setdefault(key, [0] * len(self.BUCKETS) + [0.0, 0])
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    histogram[i] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+
+    def render(self, extra=()): # Text exposition format, `extra` holds (type, name, labels, value) read at scrape time
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, list(histogram)) for key, histogram in self._histograms.items())
+        lines = []
+        typed = set()
+
+        def declare(name, kind):
+            if name not in typed:
+                lines.append(f"# TYPE {name} {kind}")
+                typed.add(name)
+
+        for (name, labels), value in counters:
+            declare(name, "counter")
+            lines.append(f"{name}{format_labels(labels)} {value}")
+        for (name, labels), histogram in histograms:
+            declare(name, "histogram")
+            for bound, count in zip(self.BUCKETS, histogram):
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', str(bound)),))} {count}")
+            lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {histogram[-1]}")
+            lines.append(f"{name}_sum{format_labels(labels)} {histogram[-2]:.6f}")
+            lines.append(f"{name}_count{format_labels(labels)} {histogram[-1]}")
+        for kind, name, labels, value in extra:
+            declare(name, kind)
+            lines.append(f"{name}{format_labels(tuple(sorted(labels.items())))} {value}")
+        return "\n".join(lines) + "\n"
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+class JobTrace: # Timing, token and cache breakdown for one award
+    def __init__(self):
+        self.started = time.time()
+        self.stages = {}  # stage -> {"count", "seconds"}
+        self.fields = {}  # field -> {"seconds", "llm_calls", "input_tokens", "output_tokens"}
+        self.counters = Counter()
+        self._lock = threading.Lock()
+
+    def add_stage(self, stage, seconds):
+        with self._lock:
+            entry = self.stages.setdefault(stage, {"count": 0, "seconds": 0.0})
+            entry["count"] += 1
+            entry["seconds"] += seconds
+
+    def add_field(self, field, **values):
+        with self._lock:
+            entry = self.fields.setdefault(field, {"seconds": 0.0, "llm_calls": 0, "input_tokens": 0, "output_tokens": 0})
+            for name, value in values.items():
+                entry[name] += value
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def to_dict(self):
+        with self._lock:
+            return {"elapsed_seconds": round(time.time() - self.started, 3),
+                    "stages": {stage: {"count": entry["count"], "seconds": round(entry["seconds"], 3)} for stage, entry in self.stages.items()},
+                    "fields": {field: {**entry, "seconds": round(entry["seconds"], 3)} for field, entry in self.fields.items()},
+                    "counters": dict(self.counters)}
+
+metrics = Metrics()
+current_trace = contextvars.ContextVar("current_trace", default=None)  # JobTrace of the award being processed
+current_field = contextvars.ContextVar("current_field", default=None)  # Field whose query is running
+
+@contextlib.contextmanager
+def span(stage): # Times a pipeline stage into the stage histogram and the current job's trace
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        metrics.inc("genai_stage_errors_total", stage=stage)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        metrics.observe("genai_stage_seconds", elapsed, stage=stage)
+        trace = current_trace.get()
+        if trace is not None:
+            trace.add_stage(stage, elapsed)
+
+def record(name, value=1, **labels): # Counter in /metrics and in the current job's trace
+    metrics.inc(f"genai_{name}_total", value, **labels)
+    trace = current_trace.get()
+    if trace is not None:
+        trace.count("_".join([name, *map(str, labels.values())]), value)
+
+#%% Azure OpenAI request scheduling
+
+current_job = contextvars.ContextVar("current_job", default=None)  # Job whose calls are being made, for fair scheduling
+
+class TokenBucket: # Continuously refilling budget of `per_minute` units
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.available = self.capacity
+        self.rate = self.capacity / 60.0
+        self.updated = time.monotonic()
+
+    def wait_time(self, amount, now): # Seconds until `amount` units are available
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+        self.updated = now
+        amount = min(amount, self.capacity)
+        return 0.0 if self.available >= amount else (amount - self.available) / self.rate
+
+    def take(self, amount):
+        self.available -= min(amount, self.capacity)
+
+def retry_after(error): # Seconds to back off if `error` is a 429 (0 when the server gave no hint), else None
+    response = getattr(error, "response", None)
+    if (getattr(error, "status_code", None) or getattr(response, "status_code", None)) != 429:
+        return None
+    headers = getattr(response, "headers", None) or {}
+    for header, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+        try:
+            return float(headers.get(header)) * scale
+        except (TypeError, ValueError):
+            continue
+    return 0.0
+
+def transient_error(error): # 5xx, timeouts and dropped connections, worth retrying but not a sign of overload
+    status = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+    if isinstance(status, int) and (status >= 500 or status == 408):
+        return True
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    try:
+        import openai
+    except ImportError:
+        return False
+    return isinstance(error, (openai.APIConnectionError, openai.APITimeoutError, openai.InternalServerError))
+
+def estimate_tokens(*texts): # Rough prompt size, ~4 characters per token
+    return sum(len(text) for text in texts) // 4 + 1
+
+class RateLimitScheduler: # Admission control for one deployment: RPM/TPM buckets, AIMD concurrency, round-robin across jobs
+    def __init__(self, name, rpm, tpm, max_concurrency, max_retries=GENAI_MAX_RETRIES):
+        self.name = name
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.limit = float(max_concurrency)  # Adaptive concurrency limit
+        self.in_flight = 0
+        self.paused_until = 0.0  # Set from Retry-After, holds back every caller
+        self.queues = OrderedDict()  # job -> waiting tickets, the first job in order is served next
+        self.calls = 0
+        self.retries = 0
+        self.throttled = 0
+        self._cond = threading.Condition()
+
+    def call(self, fn, tokens=1, job=None):
+        job = job if job is not None else current_job.get()
+        for attempt in range(self.max_retries + 1):
+            self._acquire(job, tokens)
+            try:
+                result = fn()
+            except Exception as e:
+                delay = retry_after(e)
+                if delay is None:
+                    # Not throttled: the concurrency limit stays, only this caller waits before retrying
+                    self._release(ok=False)
+                    if not transient_error(e) or attempt == self.max_retries:
+                        raise
+                    time.sleep(min(30.0, 2.0 ** attempt) * random.uniform(0.5, 1.0))
+                    reason = "transient"
+                else:
+                    if delay <= 0:
+                        delay = min(60.0, 2.0 ** attempt)
+                    self._release(ok=False, backoff=delay)
+                    if attempt == self.max_retries:
+                        raise
+                    reason = "throttled"
+                with self._cond:
+                    self.retries += 1
+                record("retries", deployment=self.name, reason=reason)
+                continue
+            self._release(ok=True)
+            return result
+
+    def _acquire(self, job, tokens):
+        ticket = object()
+        queued = time.perf_counter()
+        with self._cond:
+            self.queues.setdefault(job, deque()).append(ticket)
+            while True:
+                next_job = next(iter(self.queues))
+                if self.queues[next_job][0] is ticket:
+                    now = time.monotonic()
+                    wait = max(self.paused_until - now, self.requests.wait_time(1, now), self.tokens.wait_time(tokens, now))
+                    if wait <= 0 and self.in_flight < int(self.limit):
+                        break
+                    self._cond.wait(timeout=wait if wait > 0 else None)
+                else:
+                    self._cond.wait()
+
+            # Served: the job goes to the back of the line
+            queue = self.queues.pop(job)
+            queue.popleft()
+            if queue:
+                self.queues[job] = queue
+            self.requests.take(1)
+            self.tokens.take(tokens)
+            self.in_flight += 1
+            self.calls += 1
+            self._cond.notify_all()
+        metrics.observe("genai_scheduler_wait_seconds", time.perf_counter() - queued, deployment=self.name)
+
+    def _release(self, ok, backoff=None):
+        with self._cond:
+            self.in_flight -= 1
+            if backoff is not None:
+                # Throttled: halve the concurrency limit and pause everyone for the Retry-After period
+                self.throttled += 1
+                self.limit = max(1.0, self.limit / 2)
+                self.paused_until = max(self.paused_until, time.monotonic() + backoff)
+            elif ok:
+                self.limit = min(float(self.max_concurrency), self.limit + 1.0 / self.limit)
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {"calls": self.calls, "retries": self.retries, "throttled": self.throttled,
+                    "in_flight": self.in_flight, "concurrency_limit": round(self.limit, 2),
+                    "waiting": sum(len(queue) for queue in self.queues.values())}
+
+llm_scheduler = RateLimitScheduler("llm", GENAI_LLM_RPM, GENAI_LLM_TPM, GENAI_LLM_MAX_CONCURRENCY)
+embedding_scheduler = RateLimitScheduler("embedding", GENAI_EMBEDDING_RPM, GENAI_EMBEDDING_TPM, GENAI_EMBEDDING_MAX_CONCURRENCY)
+
+#%% Disk caches
+
+class DiskCache: # SQLite key/value store with LRU eviction and optional TTL, shared across threads and processes
+    def __init__(self, path, max_entries, ttl=None, evict_every=None):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.max_entries = max_entries
+        self.ttl = ttl or None
+        self.evict_every = evict_every or max(100, max_entries // 100)  # Writes between eviction passes, the bound may be exceeded by this much
+        self.hits = 0
+        self.misses = 0
+        self._writes = self.evict_every  # Evict on the first write after startup
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")  # No fsync per commit, WAL stays consistent on a crash
+        self._conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, created REAL, last_used REAL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS cache_last_used ON cache (last_used)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS cache_created ON cache (created)")
+        self._conn.commit()
+
+    def get_many(self, keys): # Returns {key: value} for the keys present
+        found = {}
+        keys = list(dict.fromkeys(keys))
+        oldest = time.time() - self.ttl if self.ttl else 0
+        with self._lock:
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                marks = ",".join("?" * len(chunk))
+                found.update(self._conn.execute(f"SELECT key, value FROM cache WHERE key IN ({marks}) AND created >= ?", [*chunk, oldest]).fetchall())
+            if found:
+                # Only hits move in the LRU order, a miss leaves nothing to write
+                self._conn.executemany("UPDATE cache SET last_used = ? WHERE key = ?", [(time.time(), key) for key in found])
+                self._conn.commit()
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def set_many(self, items):
+        now = time.time()
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+                                   [(key, value, now, now) for key, value in items.items()])
+            self._writes += len(items)
+            if self._writes >= self.evict_every:
+                self._writes = 0
+                if self.ttl:
+                    self._conn.execute("DELETE FROM cache WHERE created < ?", (now - self.ttl,))
+                # Evict the least recently used entries beyond the size bound
+                excess = self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0] - self.max_entries
+                if excess > 0:
+                    self._conn.execute("DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY last_used LIMIT ?)", (excess,))
+            self._conn.commit()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+embedding_cache = DiskCache(os.path.join(GENAI_CACHE_DIR, "embeddings.sqlite3"), GENAI_EMBEDDING_CACHE_SIZE)
+
+def embedding_key(text):
+    return hashlib.sha256(f"{AZURE_EMBEDDING_MODEL}\0{text}".encode("utf-8")).hexdigest()
+
+def embed_texts(texts): # Embeds through the cache, sending only the misses in one batch
+    keys = [embedding_key(text) for text in texts]
+    vectors = embedding_cache.get_many(keys)
+    missing = list(dict.fromkeys(text for text, key in zip(texts, keys) if key not in vectors))
+    record("embedding_cache", len(texts) - len(missing), result="hit")
+    record("embedding_cache", len(missing), result="miss")
+    if missing:
+        with span("embedding_request"):
+            response = embedding_scheduler.call(lambda: clients.get("embedding").embed_documents(missing), tokens=estimate_tokens(*missing))
+        new_vectors = {embedding_key(text): np.asarray(vector, dtype=np.float32).tobytes() for text, vector in zip(missing, response)}
+        embedding_cache.set_many(new_vectors)
+        vectors.update(new_vectors)
+    return [np.frombuffer(vectors[key], dtype=np.float32).tolist() for key in keys]
 
-def close_search_client(client):
-    if client is not None:
-        client.close()
-    else:
-        print("search_client is None")
+def get_embedding(text):
+    return embed_texts([text])[0]
+
+llm_cache = DiskCache(os.path.join(GENAI_CACHE_DIR, "llm.sqlite3"), GENAI_LLM_CACHE_SIZE, ttl=GENAI_LLM_CACHE_TTL)
+
+class InvalidCompletion(ValueError): # The completion could not be parsed, it is not cached
+    pass
+
+def invoke_llm(messages, use_cache=True, response_format=None, stage="llm", parse=None): # Chat completion through the response cache, use_cache=False forces a fresh call
+    """`parse` turns the completion text into the returned value. Only completions it accepts are cached,
+    one it rejects (a refusal, JSON cut off at the token limit) raises InvalidCompletion."""
+    key = hashlib.sha256(json.dumps([AZURE_DEPLOYMENT_NAME, AZURE_MODEL_NAME, LLM_TEMPERATURE, messages, response_format]).encode("utf-8")).hexdigest()
+    if use_cache:
+        cached = llm_cache.get_many([key])
+        if key in cached:
+            try:
+                value = parse(cached[key].decode("utf-8")) if parse else cached[key].decode("utf-8")
+                record("llm_cache", result="hit")
+                return value
+            except (ValueError, KeyError, TypeError):
+                pass  # Cached before completions were validated, ask again
+    record("llm_cache", result="miss" if use_cache else "bypass")
+    tokens = estimate_tokens(*(message["content"] for message in messages)) + 500  # Allow for the completion
+    llm = clients.get("llm")
+    with span(stage):
+        if response_format is not None:
+            response = llm_scheduler.call(lambda: llm.invoke(input=messages, response_format=response_format), tokens)
+        else:
+            response = llm_scheduler.call(lambda: llm.invoke(input=messages), tokens)
+    content = response.content or ""
+
+    # Token usage as reported by the service, per field
+    usage = getattr(response, "usage_metadata", None) or {}
+    field = current_field.get() or "none"
+    metrics.inc("genai_llm_calls_total", stage=stage, field=field)
+    metrics.inc("genai_llm_tokens_total", usage.get("input_tokens", 0), kind="input", field=field)
+    metrics.inc("genai_llm_tokens_total", usage.get("output_tokens", 0), kind="output", field=field)
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add_field(field, llm_calls=1, input_tokens=usage.get("input_tokens", 0), output_tokens=usage.get("output_tokens", 0))
+
+    try:
+        value = parse(content) if parse else content
+    except (ValueError, KeyError, TypeError) as e:
+        record("llm_invalid", stage=stage)
+        raise InvalidCompletion(f"Unusable {stage} completion: {e}") from e
+    if content:
+        llm_cache.set_many({key: content.encode("utf-8")})
+    return value
 
 #%% Making the index
 # index_client.create_index(index) - already created 
 
 #%% Schema of index creation
 
-from azure.search.documents.indexes.models import (
-    HnswAlgorithmConfiguration,
-    HnswParameters,
-    SearchField,
-    SearchFieldDataType,
-    SearchIndex,
-    SimpleField,
-    VectorSearch,
-    VectorSearchAlgorithmKind,
-    VectorSearchProfile,
-)
-
+# Every upload is namespaced by a filterable job_id so concurrent uploads can share the index.
+# Runs once, when the shared search client is first created.
+def ensure_search_index():
+    from azure.search.documents.indexes.models import SearchFieldDataType, SimpleField
+    index_client = clients.get("index_client")
+    index = index_client.get_index(AZURE_SEARCH_INDEX)
+    if not any(field.name == "job_id" for field in index.fields):
+        index.fields.append(SimpleField(name="job_id", type=SearchFieldDataType.String, filterable=True))
+        index_client.create_or_update_index(index)
+
+#%% Retrievers
+
+class Retriever: # Search backend interface used by prepare_document and genai_query
+    def __init__(self, job_id=None):
+        self.job_id = job_id or uuid.uuid4().hex
+        self._hits = {}
+        self._lock = threading.Lock()
+
+    def add_documents(self, documents):
+        raise NotImplementedError
+
+    def search(self, queries, k=GENAI_RETRIEVAL_K): # Returns the top document ids for each query
+        with self._lock:
+            missing = [query for query in dict.fromkeys(queries) if (query, k) not in self._hits]
+        if missing:
+            # One embedding call and one batched search for every query not seen yet
+            vectors = embed_texts(missing)
+            hits = self._search_vectors(missing, vectors, k)
+            with self._lock:
+                self._hits.update({(query, k): ids for query, ids in zip(missing, hits)})
+        return [self._hits[(query, k)] for query in queries]
+
+    def _search_vectors(self, queries, vectors, k):
+        raise NotImplementedError
+
+    def clear(self): # Removes the indexed documents, returns how many were removed
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class AzureSearchRetriever(Retriever): # Hybrid search against the shared Azure AI Search index
+    def __init__(self, search_client, job_id=None):
+        super().__init__(job_id)
+        self.search_client = search_client
+        self.document_ids = []
+
+    def add_documents(self, documents):
+        for start in range(0, len(documents), AZURE_SEARCH_BATCH_SIZE):
+            batch = documents[start:start + AZURE_SEARCH_BATCH_SIZE]
+            self.search_client.upload_documents(documents=[
+                {"id": doc["id"], "job_id": self.job_id, "embedding": doc["embedding"], "content": doc["content"]}
+                for doc in batch])
+            self.document_ids += [doc["id"] for doc in batch]
+
+    def _search_vectors(self, queries, vectors, k):
+        from azure.search.documents.models import VectorizedQuery
+
+        def search_one(query, vector):
+            results = self.search_client.search(search_text=query, select=["id"], top=k,
+                filter=f"job_id eq '{self.job_id}'", vector_queries=[
+                VectorizedQuery(vector=vector, k_nearest_neighbors=k, fields="embedding")
+            ])
+            return [doc["id"] for doc in results]
+
+        # The service takes one query per request, so a batch is sent as concurrent requests
+        if len(queries) <= 1:
+            return [search_one(query, vector) for query, vector in zip(queries, vectors)]
+        with ThreadPoolExecutor(max_workers=min(len(queries), GENAI_MAX_WORKERS)) as pool:
+            return list(pool.map(search_one, queries, vectors))
+
+    def clear(self): # Deletes only this job's documents
+        document_ids = self.document_ids
+        for start in range(0, len(document_ids), AZURE_SEARCH_BATCH_SIZE):
+            batch = document_ids[start:start + AZURE_SEARCH_BATCH_SIZE]
+            self.search_client.delete_documents(documents=[{"id": doc_id} for doc_id in batch])
+        self.document_ids = []
+        return len(document_ids)
+
+class BM25Index: # Okapi BM25 over the document texts, same defaults as Azure AI Search
+    def __init__(self, texts, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = {}  # term -> (doc indices, term frequencies)
+        self.doc_lengths = np.zeros(len(texts), dtype=np.float32)
+        for i, text in enumerate(texts):
+            terms = tokenize(text)
+            self.doc_lengths[i] = len(terms)
+            for term, count in Counter(terms).items():
+                self.postings.setdefault(term, ([], []))
+                self.postings[term][0].append(i)
+                self.postings[term][1].append(count)
+        self.postings = {term: (np.array(docs), np.array(tfs, dtype=np.float32)) for term, (docs, tfs) in self.postings.items()}
+        self.avg_length = max(float(self.doc_lengths.mean()), 1.0) if len(texts) else 1.0
+
+    def scores(self, query):
+        n = len(self.doc_lengths)
+        scores = np.zeros(n, dtype=np.float32)
+        norm = self.k1 * (1 - self.b + self.b * self.doc_lengths / self.avg_length)
+        for term in set(tokenize(query)):
+            if term not in self.postings:
+                continue
+            docs, tfs = self.postings[term]
+            idf = np.log(1 + (n - len(docs) + 0.5) / (len(docs) + 0.5))
+            scores[docs] += idf * tfs * (self.k1 + 1) / (tfs + norm[docs])
+        return scores
+
+def tokenize(text):
+    return re.findall(r"\w+", text.lower())
+
+def top_k(scores, k): # Indices of the k highest scores per row, best first
+    k = min(k, scores.shape[1])
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1)
+    return np.take_along_axis(top, order, axis=1)
+
+class LocalVectorRetriever(Retriever): # In-process index for a single award: cosine top-k with optional BM25 hybrid
+    def __init__(self, job_id=None, hybrid=GENAI_HYBRID_SEARCH):
+        super().__init__(job_id)
+        self.hybrid = hybrid
+        self.ids = []
+        self.texts = []
+        self.batches = []  # Normalized vectors added since the matrix was last built
+        self.matrix = np.empty((0, 0), dtype=np.float32)
+        self.bm25 = None
+        self._index_lock = threading.Lock()
+
+    def add_documents(self, documents):
+        if not documents:
+            return
+        vectors = np.asarray([doc["embedding"] for doc in documents], dtype=np.float32)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        with self._index_lock:
+            self.batches.append(vectors)
+            self.ids += [doc["id"] for doc in documents]
+            self.texts += [doc["content"] for doc in documents]
+        with self._lock:
+            self._hits.clear()
+
+    def _build_index(self): # Matrix and BM25 are rebuilt once at the first search after ingestion, not per batch
+        with self._index_lock:
+            if self.batches:
+                self.matrix = np.ascontiguousarray(np.vstack(([self.matrix] if self.matrix.size else []) + self.batches))
+                self.batches = []
+                self.bm25 = BM25Index(self.texts) if self.hybrid else None
+
+    def _search_vectors(self, queries, vectors, k):
+        self._build_index()
+        if not self.ids:
+            return [[] for _ in queries]
+        query_matrix = np.asarray(vectors, dtype=np.float32)
+        query_matrix /= np.maximum(np.linalg.norm(query_matrix, axis=1, keepdims=True), 1e-12)
+        vector_top = top_k(query_matrix @ self.matrix.T, k)
+        if not self.hybrid:
+            return [[self.ids[j] for j in row] for row in vector_top]
+
+        # Reciprocal rank fusion of the vector and BM25 rankings, as Azure hybrid search does
+        text_top = top_k(np.vstack([self.bm25.scores(query) for query in queries]), k)
+        hits = []
+        for vector_row, text_row in zip(vector_top, text_top):
+            fused = {}
+            for ranking in (vector_row, text_row):
+                for rank, j in enumerate(ranking):
+                    fused[j] = fused.get(j, 0.0) + 1.0 / (60 + rank + 1)
+            hits.append([self.ids[j] for j in sorted(fused, key=fused.get, reverse=True)[:k]])
+        return hits
+
+    def clear(self):
+        removed = len(self.ids)
+        self.__init__(job_id=self.job_id, hybrid=self.hybrid)
+        return removed
+
+def make_retriever(job_id=None):
+    if GENAI_RETRIEVER == "local":
+        return LocalVectorRetriever(job_id)
+    return AzureSearchRetriever(clients.get("search_client"), job_id)
+
+
+#%% Document store
+
+class DocumentStore: # Chunks of one award in a scratch SQLite file, looked up by id instead of held in memory
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.page_count = 0  # Pages in the source PDF, including pages without text
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=OFF")  # Scratch data, rebuilt if the job is rerun
+        self._conn.execute("PRAGMA synchronous=OFF")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS documents (id TEXT PRIMARY KEY, page INTEGER, paragraph INTEGER, content TEXT)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS documents_page ON documents (page)")
+
+    def add(self, docs):
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?)",
+                                   [(doc["id"], doc["page"], doc["paragraph"], doc["content"]) for doc in docs])
+            self._conn.commit()
+
+    def get_many(self, ids): # Returns {id: document} for the ids present
+        found = {}
+        ids = list(dict.fromkeys(ids))
+        with self._lock:
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                marks = ",".join("?" * len(chunk))
+                for doc_id, page, paragraph, content in self._conn.execute(
+                        f"SELECT id, page, paragraph, content FROM documents WHERE id IN ({marks})", chunk):
+                    found[doc_id] = {"id": doc_id, "page": page, "paragraph": paragraph, "content": content}
+        return found
+
+    def page_numbers(self):
+        with self._lock:
+            return [page for page, in self._conn.execute("SELECT DISTINCT page FROM documents ORDER BY page")]
+
+    def page_text(self, page): # The page rebuilt from its chunks
+        with self._lock:
+            return " ".join(content for content, in self._conn.execute("SELECT content FROM documents WHERE page = ? ORDER BY rowid", (page,)))
+
+    def pages(self):
+        return StoredPages(self)
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+
+    def close(self): # Deletes the scratch file
+        with self._lock:
+            self._conn.close()
+        with contextlib.suppress(OSError):
+            os.remove(self.path)
+
+class StoredPages(Sequence): # [(page, text)] in page order, each page read from the store when accessed
+    def __init__(self, store):
+        self.store = store
+        self.numbers = store.page_numbers()
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        page = self.numbers[index]
+        return (page, self.store.page_text(page))
 
 #%% Flask app
 app = Flask(__name__)
 
 #Defining gen_arb_df functions 
 
-def prepare_document(pdf_file, search_client): #Converting pdf to vector store
-    pdf_document = fitz.open(stream=pdf_file.read(), filetype="pdf")
-
-    # Extract text from each page of the PDF
-    texts = [page.get_text() for page in pdf_document]
-    doc_embeddings = embedding.embed_documents(texts)
-
-
-    # Generate unique IDs and add content for each document
-    documents_to_upload = [{"id": str(i + 1), "embedding": embedding, "content": text} for i, (embedding, text) in enumerate(zip(doc_embeddings, texts))]
-
-    search_client.upload_documents(documents=documents_to_upload)
-
-    return documents_to_upload
-
-def genai_query(search_query, question, documents_to_upload, search_client): # GenAI queries 
-    # Retrieve top sources for context
-    vector_store: AzureSearch = AzureSearch(
-        azure_search_endpoint=AZURE_SEARCH_ENDPOINT,
-        azure_search_key=AZURE_SEARCH_KEY,
-        index_name= AZURE_SEARCH_INDEX,
-        embedding_function=embedding.embed_query,
-    )
-
-    search_vector = get_embedding(search_query)
-    results = search_client.search(search_text=search_query, vector_queries=[
-        VectorizedQuery(vector=search_vector, k_nearest_neighbors=10, fields="embedding")
-    ])
-
-    excerpt_number = 1
-    genai_rag_context = ""  # Initialize the variable
-    max_excerpts = 7  # Limit the number of excerpts to 7
-    for doc in results:
-        if excerpt_number > max_excerpts:
-            break
-        content = next((d["content"] for d in documents_to_upload if d["id"] == doc["id"]), "")
-        genai_rag_context += f"Excerpt {excerpt_number}: {content} "
-        excerpt_number += 1
-
-    # System message
-    SYSTEM_MESSAGE = '''Assistant answers questions about arbitration awards ONLY using the context provided. 
+#%% Chunking
+
+PARAGRAPH_NUMBER = re.compile(r"^\(?(\d{1,4})[.)]\s")
+
+def page_blocks(page): # Text blocks of a page in reading order, whitespace collapsed
+    return [" ".join(block[4].split()) for block in page.get_text("blocks", sort=True) if block[6] == 0 and block[4].strip()]
+
+def block_signature(text): # Page numbers and dates vary between repeated headers and footers
+    return re.sub(r"\d+", "#", text.lower())
+
+def find_repeated_blocks(pages_blocks, max_chars=150): # Headers and footers: short edge blocks repeated on at least half of the pages
+    counts = Counter()
+    for blocks in pages_blocks:
+        counts.update({block_signature(block) for block in blocks[:2] + blocks[-2:] if len(block) <= max_chars})
+    threshold = max(3, len(pages_blocks) / 2)
+    return {signature for signature, count in counts.items() if count >= threshold}
+
+def chunk_page(page_number, blocks, repeated, min_chars=80, paragraph=None): # Paragraph chunks with page/paragraph metadata
+    # `paragraph` is the last printed paragraph number before this page. Unnumbered chunks belong to the paragraph
+    # in force (continuations, sub-paragraphs, quotations) and have None before the first printed number.
+    chunks = []
+    pending = ""
+
+    def add(text):
+        nonlocal paragraph
+        numbered = PARAGRAPH_NUMBER.match(text)
+        if numbered:
+            paragraph = int(numbered.group(1))
+        chunks.append({"page": page_number, "paragraph": paragraph, "content": text})
+
+    for i, block in enumerate(blocks):
+        if (i < 2 or i >= len(blocks) - 2) and block_signature(block) in repeated:
+            continue
+        # Short blocks (numbering, headings) are joined to the paragraph that follows
+        pending = f"{pending} {block}".strip()
+        if len(pending) < min_chars and i < len(blocks) - 1:
+            continue
+        add(pending)
+        pending = ""
+    if pending:
+        add(pending)
+    return chunks
+
+def spool_upload(pdf_file): # Copies an uploaded file object to GENAI_SPOOL_DIR in 1 MB pieces, returns the path
+    os.makedirs(GENAI_SPOOL_DIR, exist_ok=True)
+    fd, path = tempfile.mkstemp(suffix=".pdf", dir=GENAI_SPOOL_DIR)
+    try:
+        with os.fdopen(fd, "wb") as spool:
+            shutil.copyfileobj(pdf_file, spool, 1024 * 1024)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path
+
+def parse_pages(path, pages): # Text blocks of the given page indices, runs in the parse worker processes
+    import fitz  # PyMuPDF
+    with fitz.open(path) as pdf_document:
+        return [page_blocks(pdf_document[i]) for i in pages]
+
+def iter_page_blocks(path, page_count): # (page number, blocks) in page order, parsed at most a bounded window ahead of the consumer
+    ranges = iter([range(start, min(start + GENAI_PARSE_PAGES_PER_TASK, page_count)) for start in range(0, page_count, GENAI_PARSE_PAGES_PER_TASK)])
+    if GENAI_PARSE_WORKERS <= 1 or page_count <= GENAI_PARSE_PAGES_PER_TASK:
+        import fitz  # PyMuPDF
+        with fitz.open(path) as pdf_document:
+            for i in range(page_count):
+                with span("pdf_parse"):
+                    blocks = page_blocks(pdf_document[i])
+                yield i + 1, blocks
+        return
+    pool = clients.get("parse_pool")
+    window = deque((pages, pool.submit(parse_pages, path, pages)) for pages in islice(ranges, 2 * GENAI_PARSE_WORKERS))
+    while window:
+        pages, future = window.popleft()
+        with span("pdf_parse"):
+            blocks = future.result()
+        # Refill the window only as pages are consumed, so parsing never runs far ahead of embedding
+        following = next(ranges, None)
+        if following is not None:
+            window.append((following, pool.submit(parse_pages, path, following)))
+        yield from zip((i + 1 for i in pages), blocks)
+
+def index_documents(retriever, docs):
+    with span("index_documents"):
+        retriever.add_documents(docs)
+
+def prepare_document(pdf_file, retriever): # Streams a PDF (path or file object) into the index in bounded batches, returns the DocumentStore
+    import fitz  # PyMuPDF
+    spooled = not isinstance(pdf_file, (str, os.PathLike))
+    path = spool_upload(pdf_file) if spooled else os.fspath(pdf_file)
+    documents = DocumentStore(os.path.join(GENAI_SPOOL_DIR, f"{retriever.job_id}.sqlite3"))
+    try:
+        # Headers and footers are detected on an even sample of pages, PyMuPDF reads the file on demand
+        with span("pdf_parse"), fitz.open(path) as pdf_document:
+            page_count = documents.page_count = pdf_document.page_count
+            sample = sorted({round(i * (page_count - 1) / max(GENAI_HEADER_SAMPLE_PAGES - 1, 1)) for i in range(min(page_count, GENAI_HEADER_SAMPLE_PAGES))})
+            repeated = find_repeated_blocks([page_blocks(pdf_document[i]) for i in sample])
+
+        chunk_count = 0
+        pending = None  # Indexing of the previous batch, overlapped with embedding the next one
+        indexer = ThreadPoolExecutor(max_workers=1)
+
+        def flush(chunks):
+            nonlocal chunk_count, pending
+            with span("embed_documents"):
+                embeddings = embed_texts([chunk["content"] for chunk in chunks])
+            # Generate unique IDs, namespaced by the upload's job, and add content for each document
+            docs = [{"id": f"{retriever.job_id}-{chunk['page']}-{chunk_count + i + 1}", "embedding": embedding, **chunk}
+                    for i, (embedding, chunk) in enumerate(zip(embeddings, chunks))]
+            chunk_count += len(docs)
+            documents.add(docs)
+            if pending is not None:
+                pending.result()
+            pending = indexer.submit(contextvars.copy_context().run, index_documents, retriever, docs)
+
+        with indexer:
+            batch = []
+            paragraph = None  # Last printed paragraph number, carried across page breaks
+            for page_number, blocks in iter_page_blocks(path, page_count):
+                chunks = chunk_page(page_number, blocks, repeated, paragraph=paragraph)
+                if chunks:
+                    paragraph = chunks[-1]["paragraph"]
+                batch += chunks
+                if len(batch) >= GENAI_INGEST_BATCH_SIZE:
+                    flush(batch)
+                    batch = []
+            if batch:
+                flush(batch)
+            if pending is not None:
+                pending.result()
+    except BaseException:
+        documents.close()
+        raise
+    finally:
+        if spooled:
+            os.remove(path)
+
+    return documents
+
+# System message
+SYSTEM_MESSAGE = '''Assistant answers questions about arbitration awards ONLY using the context provided. 
     Answer only in the format specified. If you don't know the answer, just say "N/A". 
     Do not generate answers that don't use the context provided.'''
+
+# Structured output: answer and source in a single completion
+FIELD_ANSWER_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "answer": {"type": "string"},
+        "page": {"type": ["integer", "null"]},
+        "paragraph": {"type": ["integer", "null"]},
+        "quote": {"type": "string"},
+    },
+    "required": ["answer", "page", "paragraph", "quote"],
+    "additionalProperties": False,
+}
+STRUCTURED_INSTRUCTIONS = '''Return "answer" in the format specified, "page" and "paragraph" with the page number and paragraph number where the answer is mentioned (null if not known), 
+    and "quote" with the most relevant sentence from the context. If the answer is "N/A", explain the reasoning briefly in "quote".'''
+
+def parse_field_answer(result): # Checks one FIELD_ANSWER_SCHEMA object, raises ValueError if it does not match
+    if not isinstance(result, dict) or not isinstance(result.get("answer"), str) or not isinstance(result.get("quote"), str) \
+            or any(result.get(name) is not None and not isinstance(result[name], int) for name in ("page", "paragraph")):
+        raise ValueError(f"Not a field answer: {result!r:.200}")
+    return result
+
+def parse_field_answers(keys): # Parser for a grouped completion keyed by question id
+    def parse(content):
+        result = json.loads(content)
+        return {key: parse_field_answer(result[key]) for key in keys}
+    return parse
+
+def json_schema_format(name, schema):
+    return {"type": "json_schema", "json_schema": {"name": name, "strict": True, "schema": schema}}
+
+def format_source(result): # Source column text for a structured answer
+    if result["page"] is None:
+        return result["quote"]
+    location = f"Page {result['page']}" + (f", paragraph {result['paragraph']}" if result["paragraph"] is not None else "")
+    return f'{location}: "{result["quote"]}"'
+
+def build_context(search_queries, documents, retriever, token_budget=GENAI_CONTEXT_TOKENS):
+    # Interleave the hits so every query of a group contributes its best excerpts
+    hit_lists = retriever.search(search_queries)
+    doc_ids = list(dict.fromkeys(doc_id for rank in zip_longest(*hit_lists) for doc_id in rank if doc_id is not None))
+
+    # Pack chunks in rank order up to the token budget, skipping near-duplicates of chunks already packed
+    packed = []
+    packed_words = []
+    used = 0
+    docs = documents.get_many(doc_ids)
+    for doc_id in doc_ids:
+        doc = docs.get(doc_id)
+        if doc is None:
+            continue
+        cost = estimate_tokens(doc["content"])
+        if packed and used + cost > token_budget:
+            continue
+        words = set(tokenize(doc["content"]))
+        if any(len(words & other) >= 0.9 * len(words | other) for other in packed_words):
+            continue
+        packed.append(doc)
+        packed_words.append(words)
+        used += cost
+
+    genai_rag_context = ""
+    for excerpt_number, doc in enumerate(packed, start=1):
+        location = f"Page {doc['page']}" + (f", Paragraph {doc['paragraph']}" if doc["paragraph"] is not None else "")
+        genai_rag_context += f"Excerpt {excerpt_number} ({location}): {doc['content']} "
+    return genai_rag_context
+
+def genai_query(search_query, question, documents, retriever, use_cache=True): # GenAI queries 
+    # Retrieve top sources for context
+    with span("retrieve"):
+        genai_rag_context = build_context([search_query], documents, retriever)
     system_message = {"role": "system", "content": SYSTEM_MESSAGE}
+
+    if GENAI_STRUCTURED_OUTPUT:
+        user_message = {"role": "user", "content": question + "\n" + STRUCTURED_INSTRUCTIONS + "\n Context: " + genai_rag_context}
+        try:
+            result = invoke_llm([system_message, user_message], use_cache, json_schema_format("field_answer", FIELD_ANSWER_SCHEMA),
+                                stage="llm_structured", parse=lambda content: parse_field_answer(json.loads(content)))
+            return result["answer"], format_source(result)
+        except InvalidCompletion as e:
+            print(f"{e}, asking for the answer and source separately")
+
     # Pass query to LLM for the answer
     USER_MESSAGE_ANSWER = question + "\n Context: " + genai_rag_context
     user_message_answer = {"role": "user", "content": USER_MESSAGE_ANSWER}
-    response_answer = llm.invoke(input=[system_message, user_message_answer])
-    answer = response_answer.content
+    answer = invoke_llm([system_message, user_message_answer], use_cache, stage="llm_answer")
 
     USER_MESSAGE_SOURCE = f'''If the answer is "N/A", explain the reasoning step by step. Else, Identify the page number and paragraph number and extract the most relevant sentence from the context below where the answer to the question - {question} is mentioned. The answer should be - {answer}. The context is 
     {genai_rag_context}'''
     user_message_source = {"role": "user", "content": USER_MESSAGE_SOURCE}
-    response_source = llm.invoke(input=[system_message, user_message_source])
-    source = response_source.content
+    source = invoke_llm([system_message, user_message_source], use_cache, stage="llm_source")
 
  
     return answer, source
 
-def genai_process(documents_to_upload, search_client): #Dataframe for questions and search queries
-   
-    data = [
-            {"Field": "Country of Dispute", "Question": "In which country or countries is the dispute located?"},
-            {"Field": "Total Number of Claimants", "Question": "What is the total number of claimants in the dispute? The Claimants are the parties who have brought this dispute."},
-            {"Field": "Total Number of Respondents", "Question": "What is the total number of respondents in the dispute? The Respondents are the parties against whom the dispute has been brought. In investment arbitration, it is usually the country against which the dispute has been brought."},
-            {"Field": "Name of client", "Question": "What is the name of Claimant, if it is acting in the matter?"},
-            {"Field": "Client Sector", "Question": "What sector does the Claimant belong to? If the client is a government, choose Government and Public Sector. Choose one option among\nAgribusiness\nAirports\nAsset and Wealth Management\nAutomotive\nAviation\nBanks\nBanks and other Financial Institutions\nConnected and Autonomous Vehicles\nConsumer\nDefence\nDiagnostics and medical Devices\nElectrification\nEnergy\nEnergy Disputes\nEnergy mergers and acquisitions\nFinancial Buyers\nFintech\nGovernment and Public Sector\nHealthcare\nInfrastructure\nInsurance\nLeisure and Sport\nManufacturing and Industrials\nMining\nMobility as a service\nNuclear\nOil and Gas\nPharmaceuticals\nPharmaceuticals and Healthcare\nPharmaceuticals and Healthcare regulatory\nPorts\nPower\nPPP\nProfessional Support and Business Services\nRail\nReal Estate\nReal Estate Disputes\nRenewables\nRoads\nSocial Infrastructure\nSports Disputes\nTechnology, Media and Telecommunications\nWater and Waste"},
-            {"Field": "Name", "Question": "Apart from the Claimant, who are the parties to the case?"},
-            {"Field": "Sector(s)", "Question": "For each individual or individuals or entity or entities, what sectors are involved in the matter? Choose one among:\nAgribusiness\nAirports\nAsset and Wealth Management\nAutomotive\nAviation\nBanks\nBanks and other Financial Institutions\nConnected and Autonomous Vehicles\nConsumer\nDefence\nDiagnostics and medical Devices\nElectrification\nEnergy\nEnergy Disputes\nEnergy mergers and acquisitions\nFinancial Buyers\nFintech\nGovernment and Public Sector\nHealthcare\nInfrastructure\nInsurance\nLeisure and Sport\nManufacturing and Industrials\nMining\nMobility as a service\nNuclear\nOil and Gas\nPharmaceuticals\nPharmaceuticals and Healthcare\nPharmaceuticals and Healthcare regulatory\nPorts\nPower\nPPP\nProfessional Support and Business Services\nRail\nReal Estate\nReal Estate Disputes\nRenewables\nRoads\nSocial Infrastructure\nSports Disputes\nTechnology, Media and Telecommunications\nWater and Waste"},
-            {"Field": "Role", "Question": "For each individual/individuals or entity/entities involved, what is the role of the individual or entity in the matter? Do not include experts, law firms and legal counsel. Choose one among:\nCounterparty (select this option ONLY if the individual or entity is named in the case name (e.g. in X v. Y and Z, Y and Z are counterparties))\nNon-client (but same side as client)\nAmicus curiae\nOther"},
-            {"Field": "Name of firm", "Question": "For each law firm or independent lawyer representing a party in the dispute, what is the name of the firm or independent lawyer involved? Do not include individual experts or non-lawyers, or firms of non-lawyers or experts."},
-            {"Field": "Acting for", "Question": "For each law firm or independent lawyer, who is the firm or independent lawyer acting for? Do not include firms of non-lawyers or experts. Choose one among:\nClaimant(s)\nRespondent(s)\nAmicus curiae"},
-            {"Field": "Location of firm", "Question": "For each law firm or independent lawyer, where is the firm or independent lawyer located? Do not include individual experts or non-lawyers, or firms of non-lawyers or experts"},
-            {"Field": "Role of firm", "Question": "For each law firm or independent lawyer, what is the role of the firm or independent lawyer in the matter. Do not include individual experts or non-lawyers, or firms of non-lawyers or experts. Choose one among:\nOpposing counsel\nCo-counsel\nLocal counsel\nOpposing local counsel\nHerbert Smith Freehills is not acting in this dispute"},
-            {"Field": "Arbitration Seat (Country)", "Question": "What is the country of the city of the arbitration seat? Answer only with the name of the country"},
-            {"Field": "Arbitration Seat (City)", "Question": "What is the city of the arbitration seat? Answer only with the name of the city"},
-            {"Field": "Case Number / Reference", "Question": "What is the case number or reference? It is available on the first page"},
-            {"Field": "Arbitrator Name", "Question": "For each arbitrator, what is the name of the arbitrator? Create a list of all the arbitrators separated by \"/\"."},
-            {"Field": "Appointment Date", "Question": "For each arbitrator, what is the appointment date of the arbitrator?"},            {"Field": "Expert Name", "Question": "In international arbitration, an expert refers to a person or firm with specialized knowledge and expertise relevant to the dispute at hand. Create a list of all the experts separated by \"/\"."},
-            {"Field": "Evidence given at hearing?", "Question": "[Specific prompt]"},
-            {"Field": "Date of Award or Order", "Question": "What is the date of the award or order?"},
-            {"Field": "Dissenting Arbitrators", "Question": "Were there any dissenting arbitrators? If yes, mention their names"},
-            {"Field": "Sums Awarded (US Dollars)", "Question": "What sums were awarded in US Dollars?"},
-            {"Field": "Sums Awarded (Local Currency)", "Question": "What sums were awarded in a currency other than US dollars?"},
-            {"Field": "Award or Order issued in favour of", "Question": "In whose favor was the award or order issued?"}]
-    
-    df = pd.DataFrame(data)
+def genai_query_group(fields, documents, retriever, use_cache=True): # Several (search_query, question) pairs in one structured prompt
+    with span("retrieve"):
+        genai_rag_context = build_context([search_query for search_query, _ in fields], documents, retriever)
+    keys = [f"q{i + 1}" for i in range(len(fields))]
+    questions = "\n".join(f"Question {key}: {question}" for key, (_, question) in zip(keys, fields))
+    schema = {"type": "object", "properties": {key: FIELD_ANSWER_SCHEMA for key in keys}, "required": keys, "additionalProperties": False}
+
+    system_message = {"role": "system", "content": SYSTEM_MESSAGE}
+    user_message = {"role": "user", "content": f'''Answer each of the following questions, keyed by question id.
+    {questions}
+    For each question, {STRUCTURED_INSTRUCTIONS}
+    Context: {genai_rag_context}'''}
+    try:
+        result = invoke_llm([system_message, user_message], use_cache, json_schema_format("field_answers", schema),
+                            stage="llm_group", parse=parse_field_answers(keys))
+    except InvalidCompletion as e:
+        print(f"{e}, asking the questions one by one")
+        return [genai_query(search_query, question, documents, retriever, use_cache) for search_query, question in fields]
+    return [(result[key]["answer"], format_source(result[key])) for key in keys]
+
+#%% Deterministic extractors
+
+# Structured fields are first read straight from the text. The LLM pipeline only runs for a field
+# when no extractor is registered for it or the extraction's confidence is below the threshold.
+FIELD_EXTRACTORS = {}
+
+def field_extractor(field):
+    def register(extractor):
+        FIELD_EXTRACTORS[field] = extractor
+        return extractor
+    return register
+
+class Extraction: # A value read from the award, with its confidence and source span
+    def __init__(self, value, confidence, page, text, start, end):
+        self.value = value
+        self.confidence = confidence
+        self.page = page
+        self.text = text  # Text of the page the span refers to
+        self.start = start
+        self.end = end
+
+    @property
+    def quote(self): # The sentence around the span
+        sentence = self.text.rfind(". ", 0, self.start)
+        start = max(sentence + 2 if sentence >= 0 else 0, self.start - 200)
+        end = self.text.find(". ", self.end)
+        end = min(len(self.text) if end < 0 else end + 1, self.end + 200)
+        return self.text[start:end].strip()
+
+    @property
+    def source(self):
+        return f'Page {self.page}: "{self.quote}"'
+
+def find_all(pattern, pages): # (page, text, match) for every match
+    return [(page, text, match) for page, text in pages for match in pattern.finditer(text)]
+
+# Each further segment of the reference is a number or an upper-case code, joined without spaces,
+# so the match stops at the full stop or dash that ends the reference in running text
+CASE_NUMBER = re.compile(r"\b(?:(?:ICSID|PCA|ICC|LCIA|SCC|SIAC|HKIAC|CRCICA|ICDR|AAA|DIS|CIETAC)\s+)?Case\s+(?:No|Number|Ref(?:erence)?)\s*[.:]?\s*"
+                         r"(?:[A-Z]{1,6}\s*[/-]?\s*)?\d\w*(?:[/.-](?:\d\w*|[A-Z][A-Z\d]*)\b)*")
+
+@field_extractor("Case Number / Reference")
+def extract_case_number(pages):
+    matches = find_all(CASE_NUMBER, pages[:3])
+    if not matches:
+        return None
+    page, text, match = matches[0]
+    distinct = {re.sub(r"\s+", " ", m.group(0)) for _, _, m in matches}
+    confidence = 0.95 if page == pages[0][0] else 0.85
+    if len(distinct) > 1:
+        confidence -= 0.3
+    return Extraction(re.sub(r"\s+", " ", match.group(0)).strip(" .-/"), confidence, page, text, match.start(), match.end())
+
+MONTHS = r"(?:January|February|March|April|May|June|July|August|September|October|November|December)"
+DATE = rf"(?:\d{{1,2}}(?:st|nd|rd|th)?\s+(?:of\s+)?{MONTHS},?\s+\d{{4}}|{MONTHS}\s+\d{{1,2}}(?:st|nd|rd|th)?,?\s+\d{{4}})"
+AWARD_DATE = re.compile(rf"\b(?:(?i:Date of (?:dispatch to the parties|the Award|Award|Order))|Dated)\s*(?:on|:|-)?\s*(?P<date>{DATE})")
+
+@field_extractor("Date of Award or Order")
+def extract_award_date(pages):
+    # The date is stated on the cover page or next to the signatures at the end
+    candidates = pages[:2] + [page for page in pages[-3:] if page not in pages[:2]]
+    matches = find_all(AWARD_DATE, candidates)
+    if not matches:
+        return None
+    page, text, match = matches[0]
+    distinct = {match.group("date").lower() for _, _, match in matches}
+    confidence = 0.9 if len(distinct) == 1 else 0.5
+    return Extraction(match.group("date"), confidence, page, text, match.start("date"), match.end("date"))
+
+# Only the trigger phrase ignores case: place names are runs of capitalised words (with "of"), and a place
+# directly followed by another capitalised word or a colon (the next heading on a cover page) is not taken as complete.
+# Longer verb phrases come first so "is in London" does not give the city "in London".
+# A country is only read from this list: cover-page lines run into the next heading ("Paris, France Date of Award:"),
+# so a run of capitalised words cannot tell where the country ends. Georgia is left out, it is also a US state.
+COUNTRIES = [
+    "Afghanistan", "Albania", "Algeria", "Andorra", "Angola", "Antigua and Barbuda", "Argentina", "Armenia", "Australia", "Austria",
+    "Azerbaijan", "Bahamas", "Bahrain", "Bangladesh", "Barbados", "Belarus", "Belgium", "Belize", "Benin", "Bermuda", "Bhutan",
+    "Bolivia", "Bosnia and Herzegovina", "Botswana", "Brazil", "British Virgin Islands", "Brunei", "Bulgaria", "Burkina Faso",
+    "Burundi", "Cabo Verde", "Cambodia", "Cameroon", "Canada", "Cayman Islands", "Central African Republic", "Chad", "Chile", "China",
+    "Colombia", "Comoros", "Congo", "Costa Rica", "Côte d'Ivoire", "Croatia", "Cuba", "Cyprus", "Czech Republic", "Czechia",
+    "Democratic Republic of the Congo", "Denmark", "Djibouti", "Dominica", "Dominican Republic", "Ecuador", "Egypt", "El Salvador",
+    "England", "England and Wales", "Equatorial Guinea", "Eritrea", "Estonia", "Eswatini", "Ethiopia", "Fiji", "Finland", "France",
+    "Gabon", "Gambia", "Germany", "Ghana", "Gibraltar", "Greece", "Grenada", "Guatemala", "Guernsey", "Guinea", "Guinea-Bissau",
+    "Guyana", "Haiti", "Honduras", "Hong Kong", "Hong Kong SAR", "Hungary", "Iceland", "India", "Indonesia", "Iran", "Iraq", "Ireland",
+    "Isle of Man", "Israel", "Italy", "Ivory Coast", "Jamaica", "Japan", "Jersey", "Jordan", "Kazakhstan", "Kenya", "Kiribati",
+    "Korea", "Kosovo", "Kuwait", "Kyrgyzstan", "Laos", "Latvia", "Lebanon", "Lesotho", "Liberia", "Libya", "Liechtenstein",
+    "Lithuania", "Luxembourg", "Macau", "Madagascar", "Malawi", "Malaysia", "Maldives", "Mali", "Malta", "Marshall Islands",
+    "Mauritania", "Mauritius", "Mexico", "Micronesia", "Moldova", "Monaco", "Mongolia", "Montenegro", "Morocco", "Mozambique",
+    "Myanmar", "Namibia", "Nauru", "Nepal", "Netherlands", "New Zealand", "Nicaragua", "Niger", "Nigeria", "North Macedonia",
+    "Northern Ireland", "Norway", "Oman", "Pakistan", "Palau", "Palestine", "Panama", "Papua New Guinea", "Paraguay",
+    "People's Republic of China", "Peru", "Philippines", "Poland", "Portugal", "Qatar", "Republic of Korea", "Romania", "Russia",
+    "Russian Federation", "Rwanda", "Saint Kitts and Nevis", "Saint Lucia", "Saint Vincent and the Grenadines", "Samoa",
+    "San Marino", "Sao Tome and Principe", "Saudi Arabia", "Scotland", "Senegal", "Serbia", "Seychelles", "Sierra Leone",
+    "Singapore", "Slovakia", "Slovenia", "Solomon Islands", "Somalia", "South Africa", "South Korea", "South Sudan", "Spain",
+    "Sri Lanka", "Sudan", "Suriname", "Sweden", "Switzerland", "Syria", "Taiwan", "Tajikistan", "Tanzania", "Thailand",
+    "Timor-Leste", "Togo", "Tonga", "Trinidad and Tobago", "Tunisia", "Turkey", "Türkiye", "Turkmenistan", "Tuvalu", "U.A.E.",
+    "U.K.", "U.S.", "U.S.A.", "UAE", "UK", "US", "USA", "Uganda", "Ukraine", "United Arab Emirates", "United Kingdom",
+    "United States", "United States of America", "Uruguay", "Uzbekistan", "Vanuatu", "Venezuela", "Vietnam", "Wales", "Yemen",
+    "Zambia", "Zimbabwe"]
+
+PLACE = r"[A-Z][\w'\-]+(?:\s+(?:of\s+(?:the\s+)?)?[A-Z][\w'\-]+)*"
+COUNTRY = "|".join(re.escape(country) for country in sorted(COUNTRIES, key=len, reverse=True))  # Longest first, "England and Wales" before "England"
+# The city is followed by a listed country, or stands alone and ends before any further capitalised word or heading colon
+SEAT = re.compile(r"(?i:\b(?:legal place|seat|place) of (?:the )?arbitration(?:\s*:|\s+(?:is fixed in|was fixed in|is located in|shall be in|has been|shall be|is in|was in|is|was))\s+(?:the city of\s+)?)"
+                  rf"(?P<city>{PLACE})(?:,\s*(?:the\s+)?(?P<country>{COUNTRY})(?![\w'\-])|(?![\w'\-]|\s+[A-Z]|\s*:))")
+
+def find_seats(pages):
+    matches = find_all(SEAT, pages)
+    distinct = {(match.group("city"), match.group("country")) for _, _, match in matches}
+    return matches, distinct
+
+@field_extractor("Arbitration Seat (City)")
+def extract_seat_city(pages):
+    matches, distinct = find_seats(pages)
+    if not matches:
+        return None
+    page, text, match = matches[0]
+    # A single place name may be a country rather than a city, leave those to the LLM
+    confidence = 0.9 if match.group("country") and len(distinct) == 1 else 0.5
+    return Extraction(match.group("city"), confidence, page, text, match.start("city"), match.end("city"))
+
+@field_extractor("Arbitration Seat (Country)")
+def extract_seat_country(pages):
+    matches, distinct = find_seats(pages)
+    matches = [(page, text, match) for page, text, match in matches if match.group("country")]
+    if not matches:
+        return None
+    page, text, match = matches[0]
+    confidence = 0.9 if len(distinct) == 1 else 0.5
+    return Extraction(match.group("country"), confidence, page, text, match.start("country"), match.end("country"))
+
+ARBITRATOR = re.compile(r"(?P<name>(?:Prof(?:essor)?\.?|Dr\.?|Mr\.?|Ms\.?|Mrs\.?|Judge|Justice|Sir|Dame|H\.E\.)\s+[A-Z][\w.'\-]*(?:\s+[A-Z][\w.'\-]*){0,4})"
+                        r",?\s+(?:(?P<president>President(?: of the (?:Arbitral )?Tribunal)?|Presiding Arbitrator|Chair(?:man|person)?)|(?P<sole>Sole Arbitrator)|Co-Arbitrator|Arbitrator)\b")
+
+@field_extractor("Arbitrator Name")
+def extract_arbitrators(pages):
+    # Tribunal members are listed with their roles on the cover pages
+    matches = find_all(ARBITRATOR, pages[:3])
+    if not matches:
+        return None
+    names = list(dict.fromkeys(match.group("name") for _, _, match in matches))
+    presidents = [match for _, _, match in matches if match.group("president")]
+    sole = [match for _, _, match in matches if match.group("sole")]
+    complete = (len(names) == 3 and len(presidents) >= 1) or (len(names) == 1 and len(sole) >= 1)
+    page, text, first = matches[0]
+    last = next(match for match_page, _, match in reversed(matches) if match_page == page)
+    return Extraction(" / ".join(names), 0.9 if complete else 0.5, page, text, first.start(), last.end())
+
+def run_extractors(fields, documents, min_confidence=GENAI_EXTRACTOR_MIN_CONFIDENCE): # {field: (answer, source)} for confident extractions
+    pages = documents.pages()
+    extracted = {}
+    if not pages:
+        return extracted
+    for field in fields:
+        extractor = FIELD_EXTRACTORS.get(field)
+        extraction = extractor(pages) if extractor else None
+        if extraction is not None and extraction.value and extraction.confidence >= min_confidence:
+            extracted[field] = (extraction.value, extraction.source)
+    return extracted
+
+#%% Field catalog
+
+FIELD_CATALOG = [
+    {"Field": "Country of Dispute", "Question": "In which country or countries is the dispute located?"},
+    {"Field": "Total Number of Claimants", "Question": "What is the total number of claimants in the dispute? The Claimants are the parties who have brought this dispute."},
+    {"Field": "Total Number of Respondents", "Question": "What is the total number of respondents in the dispute? The Respondents are the parties against whom the dispute has been brought. In investment arbitration, it is usually the country against which the dispute has been brought."},
+    {"Field": "Name of client", "Question": "What is the name of Claimant, if it is acting in the matter?"},
+    {"Field": "Client Sector", "Question": "What sector does the Claimant belong to? If the client is a government, choose Government and Public Sector. Choose one option among\nAgribusiness\nAirports\nAsset and Wealth Management\nAutomotive\nAviation\nBanks\nBanks and other Financial Institutions\nConnected and Autonomous Vehicles\nConsumer\nDefence\nDiagnostics and medical Devices\nElectrification\nEnergy\nEnergy Disputes\nEnergy mergers and acquisitions\nFinancial Buyers\nFintech\nGovernment and Public Sector\nHealthcare\nInfrastructure\nInsurance\nLeisure and Sport\nManufacturing and Industrials\nMining\nMobility as a service\nNuclear\nOil and Gas\nPharmaceuticals\nPharmaceuticals and Healthcare\nPharmaceuticals and Healthcare regulatory\nPorts\nPower\nPPP\nProfessional Support and Business Services\nRail\nReal Estate\nReal Estate Disputes\nRenewables\nRoads\nSocial Infrastructure\nSports Disputes\nTechnology, Media and Telecommunications\nWater and Waste"},
+    {"Field": "Name", "Question": "Apart from the Claimant, who are the parties to the case?"},
+    {"Field": "Sector(s)", "Question": "For each individual or individuals or entity or entities, what sectors are involved in the matter? Choose one among:\nAgribusiness\nAirports\nAsset and Wealth Management\nAutomotive\nAviation\nBanks\nBanks and other Financial Institutions\nConnected and Autonomous Vehicles\nConsumer\nDefence\nDiagnostics and medical Devices\nElectrification\nEnergy\nEnergy Disputes\nEnergy mergers and acquisitions\nFinancial Buyers\nFintech\nGovernment and Public Sector\nHealthcare\nInfrastructure\nInsurance\nLeisure and Sport\nManufacturing and Industrials\nMining\nMobility as a service\nNuclear\nOil and Gas\nPharmaceuticals\nPharmaceuticals and Healthcare\nPharmaceuticals and Healthcare regulatory\nPorts\nPower\nPPP\nProfessional Support and Business Services\nRail\nReal Estate\nReal Estate Disputes\nRenewables\nRoads\nSocial Infrastructure\nSports Disputes\nTechnology, Media and Telecommunications\nWater and Waste"},
+    {"Field": "Role", "Question": "For each individual/individuals or entity/entities involved, what is the role of the individual or entity in the matter? Do not include experts, law firms and legal counsel. Choose one among:\nCounterparty (select this option ONLY if the individual or entity is named in the case name (e.g. in X v. Y and Z, Y and Z are counterparties))\nNon-client (but same side as client)\nAmicus curiae\nOther"},
+    {"Field": "Name of firm", "Question": "For each law firm or independent lawyer representing a party in the dispute, what is the name of the firm or independent lawyer involved? Do not include individual experts or non-lawyers, or firms of non-lawyers or experts."},
+    {"Field": "Acting for", "Question": "For each law firm or independent lawyer, who is the firm or independent lawyer acting for? Do not include firms of non-lawyers or experts. Choose one among:\nClaimant(s)\nRespondent(s)\nAmicus curiae"},
+    {"Field": "Location of firm", "Question": "For each law firm or independent lawyer, where is the firm or independent lawyer located? Do not include individual experts or non-lawyers, or firms of non-lawyers or experts"},
+    {"Field": "Role of firm", "Question": "For each law firm or independent lawyer, what is the role of the firm or independent lawyer in the matter. Do not include individual experts or non-lawyers, or firms of non-lawyers or experts. Choose one among:\nOpposing counsel\nCo-counsel\nLocal counsel\nOpposing local counsel\nHerbert Smith Freehills is not acting in this dispute"},
+    {"Field": "Arbitration Seat (Country)", "Question": "What is the country of the city of the arbitration seat? Answer only with the name of the country"},
+    {"Field": "Arbitration Seat (City)", "Question": "What is the city of the arbitration seat? Answer only with the name of the city"},
+    {"Field": "Case Number / Reference", "Question": "What is the case number or reference? It is available on the first page"},
+    {"Field": "Arbitrator Name", "Question": "For each arbitrator, what is the name of the arbitrator? Create a list of all the arbitrators separated by \"/\"."},
+    {"Field": "Appointment Date", "Question": "For each arbitrator, what is the appointment date of the arbitrator?"},            {"Field": "Expert Name", "Question": "In international arbitration, an expert refers to a person or firm with specialized knowledge and expertise relevant to the dispute at hand. Create a list of all the experts separated by \"/\"."},
+    {"Field": "Evidence given at hearing?", "Question": "[Specific prompt]"},
+    {"Field": "Date of Award or Order", "Question": "What is the date of the award or order?"},
+    {"Field": "Dissenting Arbitrators", "Question": "Were there any dissenting arbitrators? If yes, mention their names"},
+    {"Field": "Sums Awarded (US Dollars)", "Question": "What sums were awarded in US Dollars?"},
+    {"Field": "Sums Awarded (Local Currency)", "Question": "What sums were awarded in a currency other than US dollars?"},
+    {"Field": "Award or Order issued in favour of", "Question": "In whose favor was the award or order issued?"}]
+
+# Fields answered from a shared context in one prompt when GENAI_BATCH_FIELDS is set
+FIELD_GROUPS = [
+    ["Name of firm", "Acting for", "Location of firm", "Role of firm"],
+    ["Arbitration Seat (Country)", "Arbitration Seat (City)"],
+    ["Date of Award or Order", "Sums Awarded (US Dollars)", "Sums Awarded (Local Currency)", "Award or Order issued in favour of"],
+]
+
+#%% Field graph execution
+
+class FieldNode:
+    """A field query in the extraction graph. `fn(results)` runs once every key in `deps` has a result.
+    An `expand` node returns further FieldNodes instead of a value (used for per-name questions).
+    `label` names the field in metrics, it defaults to the key."""
+    def __init__(self, key, fn, deps=(), expand=False, label=None):
+        self.key = key
+        self.fn = fn
+        self.deps = tuple(deps)
+        self.expand = expand
+        self.label = label or key
+
+def run_node(node, results): # Runs in the field pool, timed per field
+    current_field.set(node.label)
+    start = time.perf_counter()
+    try:
+        return node.fn(results)
+    finally:
+        elapsed = time.perf_counter() - start
+        metrics.observe("genai_field_seconds", elapsed, field=node.label)
+        trace = current_trace.get()
+        if trace is not None:
+            trace.add_field(node.label, seconds=elapsed)
+
+def run_field_graph(nodes, max_workers=GENAI_MAX_WORKERS, progress=print): # Run independent nodes concurrently, returns {key: result}
+    pending = {node.key: node for node in nodes}
+    results = {}
+    running = {}
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        while pending or running:
+            ready = [key for key, node in pending.items() if all(dep in results for dep in node.deps)]
+            for key in ready:
+                node = pending.pop(key)
+                running[pool.submit(contextvars.copy_context().run, run_node, node, results)] = node
+            if not running:
+                raise ValueError(f"Unresolvable field dependencies: {sorted(pending)}")
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                node = running.pop(future)
+                try:
+                    value = future.result()
+                except Exception:
+                    for other in running:
+                        other.cancel()
+                    raise
+                if node.expand:
+                    children = value
+                    pending.update({child.key: child for child in children})
+                    results[node.key] = [child.key for child in children]
+                else:
+                    results[node.key] = value
+                    progress(f"Field: {node.key}: Success")
+    return results
+
+def genai_process(documents, retriever, max_workers=GENAI_MAX_WORKERS, use_cache=True, progress=print): #Dataframe for questions and search queries
+    import pandas as pd
+    df = pd.DataFrame(FIELD_CATALOG)
     
     df["Question"] = df["Question"].astype(str)
     df["Field"] = df["Field"].astype(str)
 
-    # Loop through dataframe to get answers and sources
-    for i in range(len(df)):
-        question = df.at[i, "Question"]
-        search_query = df.at[i, "Field"]
-        answer, source = genai_query(search_query, question, documents_to_upload, search_client)
-        df.at[i, "Answer"] = answer
-        df.at[i, "Source"] = source
-        df.reset_index(drop=True, inplace=True)
-        print(f"Field: {df.at[i, 'Field']}: Success")
-    
-    # Double checking ad hoc conditionality
+    def query(search_query, question):
+        return lambda results: genai_query(search_query, question, documents, retriever, use_cache)
+
+    def hsf_client(results):
+        return results["Acting for"][0]
+
+    def not_hsf_client(results):
+        return f"Counterparty other than {hsf_client(results)}"
+
+    def expert_names(results):
+        return results["Expert Name"][0].split(" / ")
+
+    # Follow-up questions that replace the catalog question once "Acting for" is known
+    follow_ups = {
+        "Name": lambda r: (f"Name of {not_hsf_client(r)}",
+                           f"What is the name of {not_hsf_client(r)}"),
+        "Role": lambda r: (f"Role of individual/individuals or entity/entities involved other than {hsf_client(r)}",
+                           f'''For each individual/individuals or entity/entities involved other than {hsf_client(r)}, what is the role of the individual or entity in the matter? Do not include experts, law firms and legal counsel. Choose one among:
+                    Counterparty (select this option ONLY if the individual or entity is named in the case name (e.g. in X v. Y and Z, Y and Z are counterparties))
+                    Non-client (but same side as client)
+                    Amicus curiae
+                    Other'''),
+        "No. Factual witnesses that contributed a witness statement for the Client(s)": lambda r: (
+            f"Factual witnesses that contributed a witness statement for {hsf_client(r)}",
+            f'''How many factual witnesses contributed a witness statement for {hsf_client(r)}? Include their names. Do not count or include expert witnesses.  If the number is not clear from the award, state "Number not clear"'''),
+        "No. Factual witnesses that contributed a witness statement for the Counterparty(ies)": lambda r: (
+            f"Factual witnesses that contributed a witness statement for {not_hsf_client(r)}",
+            f'''How many factual witnesses contributed a witness statement for {not_hsf_client(r)}? Include their names. Do not count or include expert witnesses.  If the number is not clear from the award, state "Number not clear"'''),
+        "Number of factual witnesses who gave evidence for client at merits hearing": lambda r: (
+            f"Number of factual witnesses who gave evidence for {hsf_client(r)} at merits hearing",
+            f'''How many factual witnesses gave evidence for the {hsf_client(r)} at the merits hearing?  Include their names. DO not include expert witnesses.  If the number is not clear from the award, state "Number not clear"'''),
+        "Number of factual witnesses who gave evidence for counterparty at merits hearing": lambda r: (
+            f"Number of factual witnesses who gave evidence for {not_hsf_client(r)} at merits hearing",
+            f'''How many factual witnesses gave evidence for {not_hsf_client(r)} at the merits hearing?  
+                        Include their names. DO not include expert witnesses.
+                        If the number is not clear from the award, state "Number not clear"'''),
+    }
+
+    # Questions asked once per expert once "Expert Name" is known
+    per_expert = {
+        "Number of expert reports produced by the expert": lambda name: (
+            f"expert reports produced by {name}", f"state how many expert reports were produced by {name}"),
+        "Evidence given at hearing?": lambda name: (
+            f"evidence given at the hearing by {name}", f"state whether evidence was given at the hearing by {name}"),
+    }
+
+    def follow_up(field):
+        def run(results):
+            search_query, question = follow_ups[field](results)
+            return genai_query(search_query, question, documents, retriever, use_cache)
+        return run
+
+    def fan_out(field):
+        def expand(results):
+            return [FieldNode(f"{field} - {name}", query(*per_expert[field](name)), label=field) for name in expert_names(results)]
+        return expand
+
+    def extracted_value(value):
+        return lambda results: value
+
+    def query_group(group):
+        def expand(results):
+            answers = genai_query_group([(field, questions[field]) for field in group], documents, retriever, use_cache)
+            return [FieldNode(field, lambda results, value=value: value) for field, value in zip(group, answers)]
+        return expand
+
+    # Build the field graph: catalog questions are independent, follow-ups wait for their inputs
+    questions = dict(zip(df["Field"], df["Question"]))
+    with span("extractors"):
+        extracted = run_extractors([field for field in questions if field not in follow_ups and field not in per_expert], documents)
+    grouped = set()
+    nodes = []
+    if GENAI_BATCH_FIELDS:
+        for group in FIELD_GROUPS:
+            if all(field in questions and field not in follow_ups and field not in per_expert for field in group):
+                group = [field for field in group if field not in extracted]
+                if len(group) > 1:
+                    nodes.append(FieldNode(" / ".join(group), query_group(group), expand=True))
+                    grouped.update(group)
+    for field, question in questions.items():
+        if field in extracted:
+            nodes.append(FieldNode(field, extracted_value(extracted[field])))
+        elif field in grouped:
+            continue
+        elif field in follow_ups:
+            nodes.append(FieldNode(field, follow_up(field), deps=["Acting for"]))
+        elif field in per_expert:
+            nodes.append(FieldNode(field, fan_out(field), deps=["Expert Name"], expand=True))
+        else:
+            nodes.append(FieldNode(field, query(field, question)))
+    # Retrieve for every catalog field in one batch before the graph starts
+    with span("retrieve_batch"):
+        retriever.search([field for field in df["Field"] if field not in follow_ups and field not in per_expert and field not in extracted])
+    with span("field_graph"):
+        results = run_field_graph(nodes, max_workers=max_workers, progress=progress)
 
     df.index = df["Field"]
+    df["Answer"] = ""
+    df["Source"] = ""
+    for field in df.index:
+        if field in per_expert:
+            for name in expert_names(results):
+                answer, source = results[f"{field} - {name}"]
+                df.loc[field, "Answer"] = df.loc[field, "Answer"] + f" {name}: " + answer + "<br>"
+                df.loc[field, "Source"] = df.loc[field, "Source"] + f"{name}: " + source + "<br>"
+        else:
+            df.loc[field, "Answer"], df.loc[field, "Source"] = results[field]
+
+    # Double checking ad hoc conditionality
     if "Type" in df.index and (df.loc["Type", "Answer"] == "Ad hoc"):
         df.loc["Institutional Arbitration Rules", "Answer"] = "N/A"
         df.loc["Institutional Arbitration Rules", "Source"] = "N/A"
@@ -203,115 +1441,147 @@ def genai_process(documents_to_upload, search_client): #Dataframe for questions
         df.loc["Administering Institution (If Administered UNCITRAL)", "Answer"] = "N/A"
         df.loc["Administering Institution (If Administered UNCITRAL)", "Source"] = "N/A"
 
-    # Assigning hsf_client 
-    if "Acting for" in df.index:
-        hsf_client = df.loc["Acting for", "Answer"]
-        not_hsf_client = f"Counterparty other than {hsf_client}"
-
-    # Name of counterparty
-    if "Name" in df.index:
-        df.loc["Name", "Answer"] = ""
-        df.loc["Name", "Source"] = ""
-
-        question = f"What is the name of {not_hsf_client}"
-        search_query = f"Name of {not_hsf_client}"
-        answer, source = genai_query(search_query, question, documents_to_upload, search_client)
-        df.loc["Name", "Answer"] = answer
-        df.loc["Name", "Source"] = source
-
-    # Role of other parties
-    if "Role" in df.index:
-        df.loc["Role", "Answer"] = ""
-        df.loc["Role", "Source"] = ""
-
-        question = f'''For each individual/individuals or entity/entities involved other than {hsf_client}, what is the role of the individual or entity in the matter? Do not include experts, law firms and legal counsel. Choose one among:
-                    Counterparty (select this option ONLY if the individual or entity is named in the case name (e.g. in X v. Y and Z, Y and Z are counterparties))
-                    Non-client (but same side as client)
-                    Amicus curiae
-                    Other'''
-        search_query = f"Role of individual/individuals or entity/entities involved other than {hsf_client}"
-        answer, source = genai_query(search_query, question, documents_to_upload, search_client)
-        df.loc["Rol", "Answer"] = answer
-        df.loc["Role", "Source"] = source
-
-    # No. Factual witnesses that contributed a witness statement for the Client(s)
-    if "No. Factual witnesses that contributed a witness statement for the Client(s)" in df.index:
-        df.loc["No. Factual witnesses that contributed a witness statement for the Client(s)", "Answer"] = ""
-        df.loc["No. Factual witnesses that contributed a witness statement for the Client(s)", "Source"] = ""
-
-        question = f'''How many factual witnesses contributed a witness statement for {hsf_client}? Include their names. Do not count or include expert witnesses.  If the number is not clear from the award, state "Number not clear"'''
-        search_query = f"Factual witnesses that contributed a witness statement for {hsf_client}"
-        answer, source = genai_query(search_query, question, documents_to_upload, search_client)
-        df.loc["No. Factual witnesses that contributed a witness statement for the Client(s)", "Answer"] = answer
-        df.loc["No. Factual witnesses that contributed a witness statement for the Client(s)", "Source"] = source
-
-    # No. Factual witnesses that contributed a witness statement for the Counterparty(ies)
-    if "No. Factual witnesses that contributed a witness statement for the Counterparty(ies)" in df.index:
-        df.loc["No. Factual witnesses that contributed a witness statement for the Counterparty(ies)", "Answer"] = ""
-        df.loc["No. Factual witnesses that contributed a witness statement for the Counterparty(ies)", "Source"] = ""
-
-        question = f'''How many factual witnesses contributed a witness statement for {not_hsf_client}? Include their names. Do not count or include expert witnesses.  If the number is not clear from the award, state "Number not clear"'''
-        search_query = f"Factual witnesses that contributed a witness statement for {not_hsf_client}"
-        answer, source = genai_query(search_query, question, documents_to_upload, search_client)
-        df.loc["No. Factual witnesses that contributed a witness statement for the Counterparty(ies)", "Answer"] = answer
-        df.loc["No. Factual witnesses that contributed a witness statement for the Counterparty(ies)", "Source"] = source
-
-    # Number of factual witnesses who gave evidence for client at merits hearing
-    if "Number of factual witnesses who gave evidence for client at merits hearing" in df.index:
-        df.loc["Number of factual witnesses who gave evidence for client at merits hearing", "Answer"] = ""
-        df.loc["Number of factual witnesses who gave evidence for client at merits hearing", "Source"] = ""
-
-        question = f'''How many factual witnesses gave evidence for the {hsf_client} at the merits hearing?  Include their names. DO not include expert witnesses.  If the number is not clear from the award, state "Number not clear"'''
-        search_query = f"Number of factual witnesses who gave evidence for {hsf_client} at merits hearing"
-        answer, source = genai_query(search_query, question, documents_to_upload, search_client)
-        df.loc["Number of factual witnesses who gave evidence for client at merits hearing", "Answer"] = answer
-        df.loc["Number of factual witnesses who gave evidence for client at merits hearing", "Source"] = source
-
-    # Number of factual witnesses who gave evidence for counterparty at merits hearing
-    if "Number of factual witnesses who gave evidence for counterparty at merits hearing" in df.index:
-        df.loc["Number of factual witnesses who gave evidence for counterparty at merits hearing", "Answer"] = ""
-        df.loc["Number of factual witnesses who gave evidence for counterparty at merits hearing", "Source"] = ""
-
-        question = f'''How many factual witnesses gave evidence for {not_hsf_client} at the merits hearing?  
-                        Include their names. DO not include expert witnesses.
-                        If the number is not clear from the award, state "Number not clear"'''
-        search_query = f"Number of factual witnesses who gave evidence for {not_hsf_client} at merits hearing"
-        answer, source = genai_query(search_query, question, documents_to_upload, search_client)
-        df.loc["Number of factual witnesses who gave evidence for counterparty at merits hearing", "Answer"] = answer
-        df.loc["Number of factual witnesses who gave evidence for counterparty at merits hearing", "Source"] = source
-
-
-        names = df.loc["Arbitrator Name", "Answer"].split(" / ")
-
-
-    # Sending questions for each expert
-    if "Number of expert reports produced by the expert" in df.index:
-        df.loc["Number of expert reports produced by the expert", "Answer"] = ""
-        df.loc["Number of expert reports produced by the expert", "Source"] = ""
-
-        names = df.loc["Expert Name", "Answer"].split(" / ")
-        for name in names:
-            question = f"state how many expert reports were produced by {name}"
-            search_query= f"expert reports produced by {name}"
-            answer, source = genai_query(search_query, question, documents_to_upload, search_client)
-            df.loc["Number of expert reports produced by the expert", "Answer"] = df.loc["Number of expert reports produced by the expert", "Answer"] + f" {name}: " + answer + "<br>"
-            df.loc["Number of expert reports produced by the expert", "Source"] = df.loc["Number of expert reports produced by the expert", "Source"] + f"{name}: " + source + "<br>"
-
-    # Evidence given at hearing
-    if "Evidence given at hearing?" in df.index:
-        df.loc["Evidence given at hearing?", "Answer"] = ""
-        df.loc["Evidence given at hearing?", "Source"] = ""
-
-        for name in names:
-            question = f"state whether evidence was given at the hearing by {name}"
-            search_query = f"evidence given at the hearing by {name}"
-            answer, source = genai_query(search_query, question, documents_to_upload, search_client)
-            df.loc["Evidence given at hearing?", "Answer"] = df.loc["Evidence given at hearing?", "Answer"] + f" {name}: " + answer + "<br>"
-            df.loc["Evidence given at hearing?", "Source"] = df.loc["Evidence given at hearing?", "Source"] + f"{name}: " + source + "<br>"
-
     df = df[["Field", "Answer", "Source"]]
     return df
-df_html = None
+def process_award(pdf_file, job_id=None, use_cache=True, progress=print, trace=None): # Index, extract and clean up one award
+    retriever = make_retriever(job_id)
+    job_token = current_job.set(retriever.job_id)
+    trace_token = current_trace.set(trace or JobTrace())
+    profiler = start_profiler()
+    documents = None
+    try:
+        with span("award"):
+            documents = prepare_document(pdf_file, retriever)
+            return genai_process(documents, retriever, use_cache=use_cache, progress=progress)
+    finally:
+        #%%Check number of documents in index
+        with span("search_cleanup"):
+            deleted = retriever.clear()
+        progress("Total pages reviewed: " + str(documents.page_count if documents is not None else 0))
+        if deleted>0:
+            progress("Documents deleted:" + str(deleted))
+        # Release the retriever, the shared search client stays open for the next upload
+        retriever.close()
+        if documents is not None:
+            documents.close()
+        stop_profiler(profiler, retriever.job_id)
+        current_trace.reset(trace_token)
+        current_job.reset(job_token)
+
+def start_profiler(): # Optional cProfile of the calling thread (field pool threads are not included)
+    if not GENAI_PROFILE_DIR:
+        return None
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError as e:  # Another profiler is already active
+        print(f"Profiling skipped: {e}")
+        return None
+    return profiler
+
+def stop_profiler(profiler, job_id):
+    if profiler is None:
+        return
+    profiler.disable()
+    os.makedirs(GENAI_PROFILE_DIR, exist_ok=True)
+    profiler.dump_stats(os.path.join(GENAI_PROFILE_DIR, f"{job_id}.prof"))
+
+def render_table(df):
+    with span("render_html"):
+        # Replace \n with <br> in the dataframe
+        df = df.replace('\n', '<br>', regex=True)
+
+        # Convert dataframe to HTML with custom styles, removing the index column
+        return df.to_html(classes='dataframe', index=False, border=0, escape=False)
+
+#%% Background jobs
+
+class Job: # One uploaded award, its progress log and its result table
+    def __init__(self, filename):
+        self.id = uuid.uuid4().hex
+        self.filename = filename
+        self.status = "queued"  # queued, running, done or failed
+        self.events = []
+        self.table = None
+        self.error = None
+        self.created = time.time()
+        self.trace = JobTrace()
+        self.changed = threading.Condition()
+
+    def log(self, message):
+        with self.changed:
+            self.events.append(str(message))
+            self.changed.notify_all()
+
+    def set_status(self, status, table=None, error=None):
+        with self.changed:
+            self.status = status
+            self.table = table
+            self.error = error
+            self.changed.notify_all()
+
+    @property
+    def finished(self):
+        return self.status in ("done", "failed")
+
+    def to_dict(self):
+        return {"id": self.id, "filename": self.filename, "status": self.status,
+                "events": list(self.events), "error": self.error, "created": self.created, "timings": self.trace.to_dict()}
+
+class JobQueueFull(Exception):
+    pass
+
+class JobStore: # Bounded, thread-safe store of jobs, oldest finished jobs are evicted first
+    def __init__(self, max_jobs, max_queued):
+        self.max_jobs = max_jobs
+        self.max_queued = max_queued
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, job): # Raises JobQueueFull rather than queue more than max_queued jobs
+        with self._lock:
+            if sum(stored.status == "queued" for stored in self._jobs.values()) >= self.max_queued:
+                raise JobQueueFull(f"{self.max_queued} uploads are already waiting, try again later")
+            self._jobs[job.id] = job
+            for job_id in [job_id for job_id, stored in self._jobs.items() if stored.finished][:max(0, len(self._jobs) - self.max_jobs)]:
+                del self._jobs[job_id]
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+jobs = JobStore(GENAI_MAX_STORED_JOBS, GENAI_MAX_QUEUED_JOBS)
+job_executor = ThreadPoolExecutor(max_workers=GENAI_JOB_WORKERS, thread_name_prefix="genai-job")
+
+def run_job(job, pdf_path, use_cache):
+    job.set_status("running")
+    try:
+        df = process_award(pdf_path, job.id, use_cache=use_cache, progress=job.log, trace=job.trace)
+        trace_token = current_trace.set(job.trace)
+        table = render_table(df)
+        current_trace.reset(trace_token)
+        job.set_status("done", table=table)
+    except Exception as e:
+        job.log(f"Error: {e}")
+        job.set_status("failed", error=str(e))
+    finally:
+        os.remove(pdf_path)
+
+def submit_job(pdf_file, use_cache=True):
+    job = Job(pdf_file.filename)
+    jobs.add(job)
+    pdf_path = None
+    try:
+        pdf_path = spool_upload(pdf_file.stream)
+        job_executor.submit(run_job, job, pdf_path, use_cache)
+    except Exception as e: # A job that never reaches the executor would otherwise stay queued and hold a queue slot
+        job.set_status("failed", error=str(e))
+        if pdf_path is not None:
+            os.remove(pdf_path)
+        raise
+    return job
+
+#%% Flask routes
 
 @app.route('/')
 def index():
@@ -320,63 +1590,97 @@ def index():
 @app.route('/upload', methods=['GET', 'POST'])
 def upload():
 #%% Flask elements
-    global df_html
     if request.method == 'POST':
-        search_client = SearchClient(
-            endpoint=AZURE_SEARCH_ENDPOINT,
-            index_name=AZURE_SEARCH_INDEX,
-            credential=AzureKeyCredential(os.getenv("AZURE_SEARCH_KEY"))
-        )
-
         if 'pdf' not in request.files:
             return redirect(url_for('index'))
         pdf_file = request.files['pdf']
         if pdf_file.filename == '':
             return redirect(url_for('index'))
-        if pdf_file:
-            # Capture console output
-            old_stdout = sys.stdout
-            sys.stdout = buffer = io.StringIO()
-            documents_to_upload = prepare_document(pdf_file, search_client)
-            df = genai_process(documents_to_upload, search_client)
-
-         #%%Check number of documents in index
-            results = search_client.search(search_text="*", select=["id"])
-            document_ids = [doc["id"] for doc in results]
-            print("Total pages reviewed: " + str(len(document_ids)))
-            if len(document_ids)>0:
-                search_client.delete_documents(documents=[{"id": doc_id} for doc_id in document_ids])
-                print("Documents deleted:" + str(len(document_ids)))
-
-
-#%% gen_arb_df import
-
-            # Replace \n with <br> in the dataframe
-            df = df.replace('\n', '<br>', regex=True)
-
-            # Convert dataframe to HTML with custom styles, removing the index column
-            df_html = df.to_html(classes='dataframe', index=False, border=0, escape=False)
-            
-            # Get console output
-            sys.stdout = old_stdout
-            console_output = buffer.getvalue()
-
-            # Ensure that the search client is closed properly
-            if search_client is not None:
-                close_search_client(search_client)
-            else:
-                print("search_client is None before closing")
-
-            return redirect(url_for('progress', console_output=console_output))
-            
-    elif request.method == 'GET' and df_html is not None:
-        return render_template('display.html', table=df_html)
+        try:
+            job = submit_job(pdf_file, use_cache=not request.form.get('bypass_cache'))
+        except JobQueueFull as e:
+            return jsonify(error=str(e)), 503, {'Retry-After': '60'}
+        if request.accept_mimetypes.best == 'application/json':
+            return jsonify(job_id=job.id, status_url=url_for('job_status', job_id=job.id),
+                           events_url=url_for('job_events', job_id=job.id)), 202
+        return redirect(url_for('progress', job_id=job.id))
+
+    job = jobs.get(request.args.get('job_id', ''))
+    if job is not None and job.status == "done":
+        return render_template('display.html', table=job.table)
+    elif job is not None:
+        return redirect(url_for('progress', job_id=job.id))
     return redirect(url_for('index'))
 
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify(error="Unknown job"), 404
+    return jsonify(job.to_dict())
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id): # Server-Sent Events stream of the job's progress
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify(error="Unknown job"), 404
+
+    def stream():
+        sent = 0
+        while True:
+            with job.changed:
+                if len(job.events) == sent and not job.finished:
+                    job.changed.wait(timeout=15)
+                events = job.events[sent:]
+                finished = job.finished
+            if not events and not finished:
+                yield ": keep-alive\n\n"
+            for event in events:
+                yield "data: " + event.replace("\n", "\ndata: ") + "\n\n"
+            sent += len(events)
+            if finished:
+                yield f"event: {job.status}\ndata: " + (job.error or job.status).replace("\n", "\ndata: ") + "\n\n"
+                return
+
+    return Response(stream_with_context(stream()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/cache/stats')
+def cache_stats():
+    return jsonify(embeddings=embedding_cache.stats(), llm=llm_cache.stats())
+
+@app.route('/scheduler/stats')
+def scheduler_stats():
+    return jsonify(llm=llm_scheduler.stats(), embeddings=embedding_scheduler.stats())
+
+@app.route('/metrics')
+def metrics_endpoint():
+    extra = []
+    for name, cache in (("embeddings", embedding_cache), ("llm", llm_cache)):
+        for result, value in cache.stats().items():
+            extra.append(("counter", "genai_cache_lookups_total", {"cache": name, "result": result}, value))
+    for scheduler in (llm_scheduler, embedding_scheduler):
+        stats = scheduler.stats()
+        for stat in ("in_flight", "concurrency_limit", "waiting"):
+            extra.append(("gauge", f"genai_scheduler_{stat}", {"deployment": scheduler.name}, stats[stat]))
+        extra.append(("counter", "genai_scheduler_throttled_total", {"deployment": scheduler.name}, stats["throttled"]))
+    return Response(metrics.render(extra), mimetype='text/plain; version=0.0.4')
+
 @app.route('/progress')
 def progress():
-    console_output = request.args.get('console_output', '')
-    return render_template('progress.html', console_output=console_output)
+    job = jobs.get(request.args.get('job_id', ''))
+    if job is None:
+        return redirect(url_for('index'))
+    return render_template('progress.html', job=job)
+
+def warm_field_embeddings(): # Precompute the static catalog query vectors
+    try:
+        embed_texts([field["Field"] for field in FIELD_CATALOG])
+    except Exception as e:
+        print(f"Warming field embeddings failed: {e}")
+
+if GENAI_WARM_EMBEDDINGS and multiprocessing.parent_process() is None:  # Not in parse or batch worker processes
+    threading.Thread(target=warm_field_embeddings, daemon=True).start()
 
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,131 @@
+#%% Batch processing of award PDFs
+# Usage: python batch.py awards/ --output results.csv --workers 4
+#        python batch.py manifest.txt --output results/ --format parquet --executor process
+#
+# Rows are appended to the output as each award finishes and every completed award is recorded in
+# <output>.checkpoint.jsonl, so re-running the same command resumes where a crashed run stopped.
+# An award that finished writing but crashed before its checkpoint line may be written twice.
+#
+# With --executor process each worker process imports the app itself and gets 1/--workers of the
+# GENAI_LLM_*/GENAI_EMBEDDING_* rate limits, so the run as a whole stays within the deployment quotas.
+
+import argparse
+import hashlib
+import importlib.util
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+# app is imported where it is used, so a process pool is started before any caches, clients or threads exist
+
+
+def find_awards(source): # A directory of PDFs or a manifest (.txt with one path per line, or .csv with a "path" column)
+    if os.path.isdir(source):
+        return sorted(os.path.join(root, name) for root, _, names in os.walk(source)
+                      for name in names if name.lower().endswith(".pdf"))
+    base = os.path.dirname(os.path.abspath(source))
+    if source.lower().endswith(".csv"):
+        paths = pd.read_csv(source)["path"].astype(str).tolist()
+    else:
+        with open(source, encoding="utf-8") as manifest:
+            paths = [line.strip() for line in manifest if line.strip() and not line.startswith("#")]
+    return [path if os.path.isabs(path) else os.path.join(base, path) for path in paths]
+
+
+def load_checkpoint(path):
+    done = set()
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as checkpoint:
+            for line in checkpoint:
+                try:
+                    done.add(json.loads(line)["award"])
+                except (ValueError, KeyError):
+                    continue  # Partially written last line from a crash
+    return done
+
+
+def init_worker(workers): # Process pool initializer: each worker gets an equal share of the quotas
+    import app
+    for scheduler in (app.llm_scheduler, app.embedding_scheduler):
+        scheduler.requests = app.TokenBucket(scheduler.requests.capacity / workers)
+        scheduler.tokens = app.TokenBucket(scheduler.tokens.capacity / workers)
+        scheduler.max_concurrency = max(1, scheduler.max_concurrency // workers)
+        scheduler.limit = float(scheduler.max_concurrency)
+
+
+def process_path(path, use_cache=True): # Runs in the worker thread or process
+    import app
+    start = time.time()
+    df = app.process_award(path, use_cache=use_cache, progress=lambda message: None)  # Read from disk page by page
+    df = df.reset_index(drop=True)
+    df.insert(0, "Award", path)
+    return df, time.time() - start
+
+
+def write_rows(df, output, output_format, path):
+    if output_format == "csv":
+        write_header = not os.path.exists(output) or os.path.getsize(output) == 0
+        df.to_csv(output, mode="a", header=write_header, index=False)
+    elif output_format == "jsonl":
+        with open(output, "a", encoding="utf-8") as out:
+            out.write(df.to_json(orient="records", lines=True, force_ascii=False).rstrip("\n") + "\n")
+    else:
+        # One part file per award, the output is a directory readable with pd.read_parquet
+        os.makedirs(output, exist_ok=True)
+        part = hashlib.sha1(path.encode("utf-8")).hexdigest()[:16]
+        df.to_parquet(os.path.join(output, f"part-{part}.parquet"), index=False)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Extract the field catalog from a batch of award PDFs.")
+    parser.add_argument("source", help="Directory of PDFs or manifest file")
+    parser.add_argument("--output", required=True, help="Output file (csv/jsonl) or directory (parquet)")
+    parser.add_argument("--format", choices=["csv", "jsonl", "parquet"], help="Defaults to the output extension, else csv")
+    parser.add_argument("--workers", type=int, default=4, help="Awards processed at once")
+    parser.add_argument("--executor", choices=["thread", "process"], default="thread")
+    parser.add_argument("--bypass-cache", action="store_true", help="Ignore cached LLM responses")
+    args = parser.parse_args(argv)
+
+    output_format = args.format or {".jsonl": "jsonl", ".parquet": "parquet"}.get(os.path.splitext(args.output)[1].lower(), "csv")
+    if output_format == "parquet":
+        # Fail before any award spends LLM calls rather than at the first write
+        if not (importlib.util.find_spec("pyarrow") or importlib.util.find_spec("fastparquet")):
+            parser.error("parquet output needs pyarrow (pip install pyarrow) or fastparquet")
+    checkpoint_path = args.output.rstrip("/\\") + ".checkpoint.jsonl"
+    done = load_checkpoint(checkpoint_path)
+    awards = [path for path in dict.fromkeys(find_awards(args.source)) if path not in done]
+    print(f"{len(awards)} awards to process, {len(done)} already done")
+
+    if args.executor == "process":
+        # Spawned, not forked: children must not inherit SQLite handles or locks held by another thread
+        pool = ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context("spawn"),
+                                   initializer=init_worker, initargs=(args.workers,))
+    else:
+        pool = ThreadPoolExecutor(max_workers=args.workers)
+    failed = 0
+    with pool, open(checkpoint_path, "a", encoding="utf-8") as checkpoint:
+        futures = {pool.submit(process_path, path, not args.bypass_cache): path for path in awards}
+        for n, future in enumerate(as_completed(futures), start=1):
+            path = futures[future]
+            try:
+                df, seconds = future.result()
+                # Rows first, then the checkpoint, so a crash never skips an award on resume
+                write_rows(df, args.output, output_format, path)
+            except Exception as e:
+                failed += 1
+                print(f"[{n}/{len(awards)}] {path}: failed: {e}", file=sys.stderr)
+                continue
+            checkpoint.write(json.dumps({"award": path, "rows": len(df), "seconds": round(seconds, 1)}) + "\n")
+            checkpoint.flush()
+            print(f"[{n}/{len(awards)}] {path}: {len(df)} rows in {seconds:.0f}s")
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,350 @@
+#%% Offline benchmark of the extraction pipeline
+# Usage: python benchmark.py --pages 10,100,500 --awards 3 --output bench.json
+#        python benchmark.py --pages 10,100,500 --awards 3 --baseline bench.json
+#
+# Runs process_award (prepare_document -> genai_process -> index cleanup) on synthetic award PDFs against
+# local stand-ins for Azure OpenAI and Azure AI Search, so no quota is spent and results are repeatable.
+# Reports awards/minute, p50/p95 seconds per stage and per award, LLM calls and peak memory for each PDF size.
+# Stage times are summed over the calls within one award (parallel LLM calls can exceed the award's wall time).
+# With --baseline the run is compared to a saved --output file and the exit code is 1 on a regression.
+
+import argparse
+import hashlib
+import io
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import numpy as np
+
+try:
+    import resource  # Not available on Windows
+except ImportError:
+    resource = None
+
+
+#%% Local stand-ins for the Azure services
+
+class HashEmbeddings: # Deterministic bag-of-words vectors, related texts get similar embeddings
+    def __init__(self, dimensions=256, latency=0.0):
+        self.dimensions = dimensions
+        self.latency = latency
+        self.requests = 0
+
+    def embed(self, text):
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        for term in re.findall(r"\w+", text.lower()):
+            digest = hashlib.blake2b(term.encode("utf-8"), digest_size=4).digest()
+            vector[int.from_bytes(digest, "little") % self.dimensions] += 1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts):
+        self.requests += 1
+        time.sleep(self.latency)
+        return [self.embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+class InMemorySearchClient: # The part of azure.search.documents.SearchClient the app uses, hybrid ranked with RRF
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.documents = {}  # id -> document
+        self._lock = threading.Lock()
+
+    def upload_documents(self, documents):
+        time.sleep(self.latency)
+        with self._lock:
+            for document in documents:
+                # Stored compactly so the stand-in's own memory does not hide the pipeline's
+                self.documents[document["id"]] = {**document, "embedding": np.asarray(document["embedding"], dtype=np.float32),
+                                                  "terms": set(re.findall(r"\w+", document["content"].lower()))}
+        return [SimpleNamespace(key=document["id"], succeeded=True) for document in documents]
+
+    def delete_documents(self, documents):
+        time.sleep(self.latency)
+        with self._lock:
+            for document in documents:
+                self.documents.pop(document["id"], None)
+        return [SimpleNamespace(key=document["id"], succeeded=True) for document in documents]
+
+    def get_document_count(self):
+        return len(self.documents)
+
+    def search(self, search_text=None, select=None, top=50, filter=None, vector_queries=None):
+        time.sleep(self.latency)
+        job = re.fullmatch(r"job_id eq '(.*)'", filter).group(1) if filter else None
+        with self._lock:
+            candidates = [document for document in self.documents.values() if job is None or document["job_id"] == job]
+        rankings = []
+        if search_text:
+            terms = set(re.findall(r"\w+", search_text.lower()))
+            rankings.append(sorted(candidates, key=lambda document: -len(terms & document["terms"])))
+        for query in vector_queries or []:
+            if candidates:
+                scores = np.vstack([document["embedding"] for document in candidates]) @ np.asarray(query.vector, dtype=np.float32)
+                rankings.append([candidates[i] for i in np.argsort(-scores)[:query.k_nearest_neighbors]])
+        fused = Counter()
+        for ranking in rankings:
+            for rank, document in enumerate(ranking):
+                fused[document["id"]] += 1.0 / (60 + rank + 1)
+        return [{field: self.documents.get(doc_id, {}).get(field) for field in select or ["id", "content"]}
+                for doc_id, _ in fused.most_common(top)]
+
+    def close(self):
+        pass
+
+class Throttled(Exception): # Shaped like the openai SDK's RateLimitError as far as app.retry_after is concerned
+    status_code = 429
+
+    def __init__(self, retry_after_ms):
+        super().__init__(f"429 Too Many Requests, retry after {retry_after_ms} ms")
+        self.response = SimpleNamespace(status_code=429, headers={"retry-after-ms": str(retry_after_ms)})
+
+class FakeChat: # Chat model stand-in with latency, a concurrency/RPM limit returning 429s, and schema-shaped answers
+    NAMES = ["Alex Moreau", "Priya Shah", "Daniel Okafor", "Mei Lin", "Jonas Berg"]
+
+    def __init__(self, latency=0.05, max_concurrency=0, rpm=0):
+        self.latency = latency
+        self.max_concurrency = max_concurrency
+        self.rpm = rpm
+        self.calls = 0
+        self.throttled = 0
+        self.in_flight = 0
+        self.recent = deque()  # Start times of calls in the last minute
+        self._lock = threading.Lock()
+
+    def invoke(self, input, response_format=None):
+        prompt = json.dumps(input)
+        seed = int(hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:8], 16)
+        with self._lock:
+            now = time.monotonic()
+            while self.recent and now - self.recent[0] > 60:
+                self.recent.popleft()
+            if self.rpm and len(self.recent) >= self.rpm:  # Retry once the oldest call leaves the 60 s window
+                self.throttled += 1
+                raise Throttled(max(1, int((self.recent[0] + 60 - now) * 1000)))
+            if self.max_concurrency and self.in_flight >= self.max_concurrency:
+                self.throttled += 1
+                raise Throttled(50)
+            self.calls += 1
+            self.in_flight += 1
+            self.recent.append(now)
+        try:
+            time.sleep(self.latency * (0.5 + (seed % 1000) / 1000))  # 0.5x to 1.5x the configured latency
+            if response_format is not None:
+                content = json.dumps(self.fake_value(response_format["json_schema"]["schema"], seed))
+            else:
+                content = self.fake_text(seed)
+            return SimpleNamespace(content=content, usage_metadata={"input_tokens": len(prompt) // 4, "output_tokens": len(content) // 4})
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def fake_text(self, seed):
+        return f"{self.NAMES[seed % len(self.NAMES)]} / {self.NAMES[(seed // 7) % len(self.NAMES)]}"
+
+    def fake_value(self, schema, seed):
+        kind = schema.get("type")
+        kind = next((option for option in kind if option != "null"), "null") if isinstance(kind, list) else kind
+        if kind == "object":
+            return {name: self.fake_value(child, seed + i) for i, (name, child) in enumerate(schema.get("properties", {}).items())}
+        if kind == "integer":
+            return seed % 40 + 1
+        if kind == "string":
+            return self.fake_text(seed)
+        return None
+
+
+#%% Synthetic awards
+
+SENTENCES = [
+    "The Claimant submits that the Respondent failed to make payment under the Agreement.",
+    "The Tribunal has considered the witness statements and the expert reports filed by the Parties.",
+    "The Respondent contends that the termination notice was served in accordance with clause {n}.",
+    "Having heard the evidence at the hearing, the Tribunal finds that the delay was not excusable.",
+    "The quantum expert for the Claimant assessed the loss at USD {n} million.",
+    "The Parties agreed that the seat of the arbitration shall be {city}.",
+    "Counsel for the Respondent cross-examined the Claimant's witness on the project schedule.",
+    "The Tribunal declines the request for document production as it is not relevant or material.",
+    "Interest shall accrue at the rate of {n} per cent per annum from the date of this Award.",
+    "The costs of the arbitration shall be borne by the Parties in equal shares.",
+]
+CITIES = [("Paris", "France"), ("London", "United Kingdom"), ("Singapore", "Singapore"), ("Geneva", "Switzerland")]
+
+def make_award_pdf(pages, seed=0): # Award-like PDF with a cover page, numbered paragraphs and a repeated header/footer
+    import fitz  # PyMuPDF
+    rng = random.Random(seed)
+    city, country = rng.choice(CITIES)
+    case_number = f"ICC Case No. {rng.randint(10000, 29999)}/{rng.choice(['ABC', 'MK', 'JPA'])}"
+    document = fitz.open()
+    cover = document.new_page()
+    cover.insert_textbox(fitz.Rect(72, 72, 540, 760), "\n\n".join([
+        "INTERNATIONAL CHAMBER OF COMMERCE", case_number, "FINAL AWARD",
+        f"Northwind Holdings Ltd (Claimant) v Southbank Energy S.A. (Respondent) - award {seed}",
+        f"Seat of arbitration: {city}, {country}",
+        "Arbitral Tribunal: Alex Moreau (President), Priya Shah, Daniel Okafor",
+        f"Date of Award: {rng.randint(1, 28)} March 20{rng.randint(10, 24)}",
+    ]), fontsize=11)
+    paragraph = 0
+    for number in range(2, pages + 1):
+        page = document.new_page()
+        page.insert_text((72, 40), f"{case_number} - Final Award", fontsize=8)
+        page.insert_text((290, 810), f"Page {number} of {pages}", fontsize=8)
+        paragraphs = []
+        for _ in range(5):
+            paragraph += 1
+            text = " ".join(rng.choice(SENTENCES).format(n=rng.randint(2, 90), city=city) for _ in range(rng.randint(2, 4)))
+            paragraphs.append(f"{paragraph}. {text} (award {seed})")
+        page.insert_textbox(fitz.Rect(72, 72, 540, 780), "\n\n".join(paragraphs), fontsize=10)
+    pdf_bytes = document.tobytes()
+    document.close()
+    return pdf_bytes
+
+
+#%% Benchmark run
+
+def percentile(values, q):
+    return round(float(np.percentile(values, q)), 4) if values else None
+
+def max_rss_mb(): # Process high-water mark, sizes run in ascending order so each reading covers its size
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def run_size(app, pages, awards, concurrency, chat, seed, trace_memory):
+    # The page count is part of the seed: awards of different sizes must not share text, or the embedding
+    # cache would serve the larger awards' first pages from the smaller sizes' runs
+    pdfs = [make_award_pdf(pages, seed=f"{seed}-{pages}-{i}") for i in range(awards)]
+    traces = [app.JobTrace() for _ in pdfs]
+    calls, throttled = chat.calls, chat.throttled
+    award_seconds = []
+
+    def run(i):
+        start = time.perf_counter()
+        app.process_award(io.BytesIO(pdfs[i]), use_cache=False, progress=lambda message: None, trace=traces[i])
+        award_seconds.append(time.perf_counter() - start)
+
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(run, range(awards)))
+    wall = time.perf_counter() - start
+    if trace_memory:
+        peak_memory = round(tracemalloc.get_traced_memory()[1] / (1024 * 1024), 1)
+        tracemalloc.stop()
+    else:
+        peak_memory = max_rss_mb()
+
+    stages = {}
+    for trace in traces:
+        for stage, entry in trace.to_dict()["stages"].items():
+            stages.setdefault(stage, []).append(entry["seconds"])
+    return {"awards": awards, "wall_seconds": round(wall, 3), "awards_per_minute": round(awards * 60 / wall, 2),
+            "award_seconds": {"p50": percentile(award_seconds, 50), "p95": percentile(award_seconds, 95)},
+            "stages": {stage: {"p50": percentile(seconds, 50), "p95": percentile(seconds, 95)} for stage, seconds in sorted(stages.items())},
+            "llm_calls": chat.calls - calls, "llm_calls_per_award": round((chat.calls - calls) / awards, 1),
+            "throttled": chat.throttled - throttled, "peak_memory_mb": peak_memory}
+
+def flatten(size_result): # metric name -> (value, True if higher is better)
+    metrics = {"awards_per_minute": (size_result["awards_per_minute"], True),
+               "llm_calls_per_award": (size_result["llm_calls_per_award"], False),
+               "peak_memory_mb": (size_result["peak_memory_mb"], False)}
+    for q in ("p50", "p95"):
+        metrics[f"award.{q}"] = (size_result["award_seconds"][q], False)
+        for stage, values in size_result["stages"].items():
+            metrics[f"{stage}.{q}"] = (values[q], False)
+    return metrics
+
+def compare(baseline, results, tolerance, min_seconds=0.005): # Prints a comparison, returns the regressed metrics
+    if baseline.get("config") != results["config"]:
+        print("Warning: baseline was recorded with a different configuration", file=sys.stderr)
+    regressions = []
+    print(f"\n{'size':>6} {'metric':<28} {'baseline':>10} {'current':>10} {'change':>8}")
+    for size, current in results["sizes"].items():
+        if size not in baseline.get("sizes", {}):
+            continue
+        before = flatten(baseline["sizes"][size])
+        for name, (value, higher_is_better) in flatten(current).items():
+            old = before.get(name, (None,))[0]
+            if old is None or value is None:
+                continue
+            change = (value - old) / old if old else 0.0
+            worse = -change if higher_is_better else change
+            # Sub-millisecond stages are timer noise, judge them on absolute time
+            regressed = worse > tolerance and (name.count(".") == 0 or max(value, old) >= min_seconds)
+            if regressed:
+                regressions.append(f"{size} pages {name}")
+            print(f"{size:>6} {name:<28} {old:>10} {value:>10} {change:>+7.0%}{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the award pipeline offline against local service stand-ins.")
+    parser.add_argument("--pages", default="10,100,500", help="Comma separated PDF sizes, 10 to 2000 pages")
+    parser.add_argument("--awards", type=int, default=3, help="Awards per size, each with different text")
+    parser.add_argument("--concurrency", type=int, default=1, help="Awards processed at once")
+    parser.add_argument("--retriever", choices=["azure", "local"], default="azure", help="azure uses the in-memory SearchClient")
+    parser.add_argument("--chat-latency", type=float, default=0.05, help="Mean seconds per chat completion")
+    parser.add_argument("--chat-max-concurrency", type=int, default=0, help="Concurrent completions before 429s, 0 = unlimited")
+    parser.add_argument("--chat-rpm", type=int, default=0, help="Completions per minute before 429s, 0 = unlimited")
+    parser.add_argument("--embedding-latency", type=float, default=0.01, help="Seconds per embedding request")
+    parser.add_argument("--search-latency", type=float, default=0.0, help="Seconds per search request")
+    parser.add_argument("--tracemalloc", action="store_true", help="Peak Python heap per size instead of process max RSS (slower)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write results as JSON, usable as a later --baseline")
+    parser.add_argument("--baseline", help="Results JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="Allowed relative slowdown before a regression")
+    args = parser.parse_args(argv)
+
+    # The app reads its configuration at import: fresh caches, no warm-up, quota limits out of the way of the stand-ins
+    os.environ["GENAI_CACHE_DIR"] = tempfile.mkdtemp(prefix="genai-bench-")
+    os.environ["GENAI_WARM_EMBEDDINGS"] = "false"
+    os.environ["GENAI_RETRIEVER"] = args.retriever
+    for name in ("GENAI_LLM_RPM", "GENAI_LLM_TPM", "GENAI_EMBEDDING_RPM", "GENAI_EMBEDDING_TPM"):
+        os.environ.setdefault(name, "100000000")
+    import app
+
+    chat = FakeChat(args.chat_latency, args.chat_max_concurrency, args.chat_rpm)
+    app.clients.override("llm", chat)
+    app.clients.override("embedding", HashEmbeddings(latency=args.embedding_latency))
+    app.clients.override("search_client", InMemorySearchClient(latency=args.search_latency))
+
+    config = {name: value for name, value in vars(args).items() if name not in ("output", "baseline", "tolerance", "pages")}
+    config.update({name: getattr(app, name) for name in ("GENAI_MAX_WORKERS", "GENAI_STRUCTURED_OUTPUT", "GENAI_BATCH_FIELDS", "GENAI_CONTEXT_TOKENS")})
+    results = {"config": config, "sizes": {}}
+    for pages in sorted(int(size) for size in args.pages.split(",")):
+        print(f"{pages} pages x {args.awards} awards...", flush=True)
+        size_result = run_size(app, pages, args.awards, args.concurrency, chat, args.seed, args.tracemalloc)
+        results["sizes"][str(pages)] = size_result
+        print(f"  {size_result['awards_per_minute']} awards/min, award p50 {size_result['award_seconds']['p50']}s "
+              f"p95 {size_result['award_seconds']['p95']}s, {size_result['llm_calls_per_award']} LLM calls/award, "
+              f"{size_result['throttled']} throttled, peak memory {size_result['peak_memory_mb']} MB")
+        for stage, values in size_result["stages"].items():
+            print(f"    {stage:<20} p50 {values['p50']:>8}s  p95 {values['p95']:>8}s")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as out:
+            json.dump(results, out, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as baseline_file:
+            regressions = compare(json.load(baseline_file), results, args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} regressions: " + ", ".join(regressions), file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
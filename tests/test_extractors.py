@@ -0,0 +1,134 @@
+#%% Deterministic extractor tests
+# Run with: python -m unittest discover tests  (or pytest)
+#
+# Confident extractions skip the LLM, so a wrong value here is never checked. Cases use cover-page and
+# body sentences as they appear in awards, including the ones that previously produced wrong values.
+
+import os
+import sys
+import tempfile
+import unittest
+
+os.environ.setdefault("GENAI_CACHE_DIR", tempfile.mkdtemp(prefix="genai-test-"))
+os.environ.setdefault("GENAI_WARM_EMBEDDINGS", "false")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+
+
+def extract(extractor, *texts): # Runs an extractor on pages numbered from 1
+    return extractor([(i + 1, text) for i, text in enumerate(texts)])
+
+
+class CaseNumberTest(unittest.TestCase):
+    def assertCaseNumber(self, text, expected):
+        extraction = extract(app.extract_case_number, text)
+        self.assertIsNotNone(extraction, text)
+        self.assertEqual(extraction.value, expected)
+
+    def test_institution_references(self):
+        self.assertCaseNumber("INTERNATIONAL CENTRE FOR SETTLEMENT OF INVESTMENT DISPUTES ICSID Case No. ARB/15/3 AWARD", "ICSID Case No. ARB/15/3")
+        self.assertCaseNumber("INTERNATIONAL CHAMBER OF COMMERCE ICC Case No. 24567/MK FINAL AWARD", "ICC Case No. 24567/MK")
+        self.assertCaseNumber("LCIA Case No. 173781 between Northwind Holdings Ltd and Southbank Energy S.A.", "LCIA Case No. 173781")
+        self.assertCaseNumber("Arbitration Institute of the Stockholm Chamber of Commerce SCC Case No. V 2019/123", "SCC Case No. V 2019/123")
+
+    def test_stops_at_the_end_of_the_reference(self):
+        self.assertCaseNumber("ICC Case No. 21345. The Tribunal was constituted on 3 May 2021.", "ICC Case No. 21345")
+        self.assertCaseNumber("PCA Case No. 2014-02 - Award on Jurisdiction", "PCA Case No. 2014-02")
+        self.assertCaseNumber("Case No. 12345/2021.The Claimant", "Case No. 12345/2021")
+
+    def test_conflicting_references_are_not_confident(self):
+        extraction = extract(app.extract_case_number, "ICC Case No. 21345/ABC", "ICC Case No. 99999/XYZ")
+        self.assertLess(extraction.confidence, app.GENAI_EXTRACTOR_MIN_CONFIDENCE)
+
+    def test_no_reference(self):
+        self.assertIsNone(extract(app.extract_case_number, "The case was heard in London over five days."))
+
+
+class AwardDateTest(unittest.TestCase):
+    def test_cover_page_date(self):
+        extraction = extract(app.extract_award_date, "FINAL AWARD Date of dispatch to the parties: 14 March 2022")
+        self.assertEqual(extraction.value, "14 March 2022")
+        self.assertGreaterEqual(extraction.confidence, app.GENAI_EXTRACTOR_MIN_CONFIDENCE)
+
+    def test_signature_page_date(self):
+        extraction = extract(app.extract_award_date, "FINAL AWARD", "The Claimant submits...", "Dated: March 3rd, 2020 Place of arbitration: Paris")
+        self.assertEqual(extraction.value, "March 3rd, 2020")
+
+    def test_lower_case_dated_is_not_the_award_date(self):
+        self.assertIsNone(extract(app.extract_award_date, "The Agreement dated 1 June 2015 provides for ICC arbitration."))
+
+    def test_conflicting_dates_are_not_confident(self):
+        extraction = extract(app.extract_award_date, "Date of Award: 1 June 2021", "Dated 2 July 2021")
+        self.assertLess(extraction.confidence, app.GENAI_EXTRACTOR_MIN_CONFIDENCE)
+
+
+class SeatTest(unittest.TestCase):
+    def seat(self, *texts):
+        city = extract(app.extract_seat_city, *texts)
+        country = extract(app.extract_seat_country, *texts)
+        return (city and city.value, country and country.value, city and city.confidence)
+
+    def test_city_and_country(self):
+        city, country, confidence = self.seat("The seat of the arbitration is in London, England.")
+        self.assertEqual((city, country), ("London", "England"))
+        self.assertGreaterEqual(confidence, app.GENAI_EXTRACTOR_MIN_CONFIDENCE)
+
+    def test_stops_at_prose(self):
+        self.assertEqual(self.seat("The seat of arbitration is Paris, France and the language of the arbitration is English.")[:2],
+                         ("Paris", "France"))
+        self.assertEqual(self.seat("The legal place of arbitration shall be New York, United States of America.")[:2],
+                         ("New York", "United States of America"))
+
+    def test_unrecognised_phrasing_is_left_to_the_llm(self):
+        self.assertEqual(self.seat("The place of arbitration was agreed to be Singapore, as the parties confirmed."), (None, None, None))
+
+    def test_cover_page_heading_is_not_part_of_the_place(self):
+        # Page text joins cover-page lines with spaces, so the next heading follows the country directly
+        for text, expected in [("Seat of Arbitration: Geneva, Switzerland Arbitral Tribunal: Alex Moreau (President)", ("Geneva", "Switzerland")),
+                               ("Seat of arbitration: Paris, France Date of Award: 3 March 2020", ("Paris", "France")),
+                               ("Place of Arbitration: Paris, France FINAL AWARD", ("Paris", "France")),
+                               ("Seat of arbitration: London, England Claimant", ("London", "England")),
+                               ("Seat of arbitration: New York, United States of America Arbitral Tribunal", ("New York", "United States of America"))]:
+            self.assertEqual(self.seat(text)[:2], expected, text)
+
+    def test_unlisted_country_is_not_confident(self):
+        city, country, confidence = self.seat("Seat of arbitration: Manama, Kingdom of Bahrain Date of Award: 3 March 2020")
+        self.assertEqual((city, country), ("Manama", None))
+        self.assertLess(confidence, app.GENAI_EXTRACTOR_MIN_CONFIDENCE)
+
+    def test_city_without_country_is_not_confident(self):
+        city, country, confidence = self.seat("Place of arbitration: Stockholm")
+        self.assertEqual((city, country), ("Stockholm", None))
+        self.assertLess(confidence, app.GENAI_EXTRACTOR_MIN_CONFIDENCE)
+
+
+class SourceTest(unittest.TestCase):
+    def test_quote_is_the_sentence_around_the_value(self):
+        extraction = extract(app.extract_seat_city, "The hearing was held in May. The seat of the arbitration is in London, England. Costs follow.")
+        self.assertEqual(extraction.source, 'Page 1: "The seat of the arbitration is in London, England."')
+
+    def test_quote_at_the_start_of_the_page(self):
+        extraction = extract(app.extract_case_number, "ICC Case No. 24567/MK FINAL AWARD")
+        self.assertEqual(extraction.source, 'Page 1: "ICC Case No. 24567/MK FINAL AWARD"')
+
+
+class ArbitratorsTest(unittest.TestCase):
+    def test_three_member_tribunal(self):
+        extraction = extract(app.extract_arbitrators, "Arbitral Tribunal: Prof. Jane Smith, President Dr. Hans Weber, Co-Arbitrator "
+                                                      "Mr. Ravi Kumar, Co-Arbitrator")
+        self.assertEqual(extraction.value, "Prof. Jane Smith / Dr. Hans Weber / Mr. Ravi Kumar")
+        self.assertGreaterEqual(extraction.confidence, app.GENAI_EXTRACTOR_MIN_CONFIDENCE)
+
+    def test_sole_arbitrator(self):
+        extraction = extract(app.extract_arbitrators, "Before: Sir Peter Gray, Sole Arbitrator")
+        self.assertEqual(extraction.value, "Sir Peter Gray")
+        self.assertGreaterEqual(extraction.confidence, app.GENAI_EXTRACTOR_MIN_CONFIDENCE)
+
+    def test_incomplete_tribunal_is_not_confident(self):
+        extraction = extract(app.extract_arbitrators, "Ms. Anna Lee, Arbitrator")
+        self.assertLess(extraction.confidence, app.GENAI_EXTRACTOR_MIN_CONFIDENCE)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,100 @@
+#%% RateLimitScheduler tests
+# Run with: python -m unittest discover tests  (or pytest)
+#
+# The scheduler is driven with benchmark.FakeChat, which answers 429s with a Retry-After like Azure OpenAI does.
+# Limits are generous wherever a test is not about them, so only the behaviour under test can slow a call down.
+
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault("GENAI_CACHE_DIR", tempfile.mkdtemp(prefix="genai-test-"))
+os.environ.setdefault("GENAI_WARM_EMBEDDINGS", "false")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+from benchmark import FakeChat, Throttled
+
+
+def scheduler(max_concurrency=4, max_retries=3):
+    return app.RateLimitScheduler("test", rpm=100_000, tpm=10_000_000, max_concurrency=max_concurrency, max_retries=max_retries)
+
+
+class Failing: # Raises the given errors in turn, then returns "ok"
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "ok"
+
+
+class RateLimitSchedulerTest(unittest.TestCase):
+    def test_calls_succeed_within_the_concurrency_limit(self):
+        chat, limiter = FakeChat(latency=0.01, max_concurrency=2), scheduler(max_concurrency=2)
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            results = list(pool.map(lambda i: limiter.call(lambda: chat.invoke(f"prompt {i}")), range(20)))
+        self.assertEqual(len(results), 20)
+        self.assertTrue(all(result.content for result in results))
+        self.assertEqual((chat.calls, chat.throttled, limiter.retries), (20, 0, 0))
+
+    def test_throttling_halves_the_limit_and_every_call_still_succeeds(self):
+        chat, limiter = FakeChat(latency=0.02, max_concurrency=1), scheduler(max_concurrency=4, max_retries=10)
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            results = list(pool.map(lambda i: limiter.call(lambda: chat.invoke(f"prompt {i}")), range(8)))
+        self.assertEqual(len(results), 8)
+        self.assertGreater(chat.throttled, 0)
+        self.assertEqual(limiter.throttled, chat.throttled)
+        self.assertLess(limiter.limit, 4)
+
+    def test_a_429_halves_the_limit(self):
+        limiter, fn, limits = scheduler(max_concurrency=4), Failing(Throttled(1)), []
+        self.assertEqual(limiter.call(lambda: (limits.append(limiter.limit), fn())[1]), "ok")
+        self.assertEqual(limits, [4.0, 2.0])
+        self.assertEqual((limiter.throttled, limiter.retries), (1, 1))
+        self.assertEqual(limiter.limit, 2.5)  # The success after the retry grows it again, by 1 / limit
+
+    def test_retry_after_is_honoured(self):
+        limiter = scheduler()
+        start = time.monotonic()
+        self.assertEqual(limiter.call(Failing(Throttled(300))), "ok")
+        self.assertGreaterEqual(time.monotonic() - start, 0.3)
+
+    def test_retry_after_pauses_every_caller(self):
+        chat, limiter = FakeChat(latency=0, rpm=1), scheduler(max_retries=0)
+        limiter.call(lambda: chat.invoke("first"))
+        with self.assertRaises(Throttled):
+            limiter.call(lambda: chat.invoke("second"))
+        # The RPM window is a minute, so the pause runs until the first call leaves it
+        self.assertGreater(limiter.paused_until - time.monotonic(), 55)
+        finished = threading.Event()
+        threading.Thread(target=lambda: (limiter.call(lambda: None), finished.set()), daemon=True).start()
+        self.assertFalse(finished.wait(0.2))
+
+    def test_other_errors_are_not_retried(self):
+        limiter, fn = scheduler(), Failing(ValueError("bad request"))
+        with self.assertRaises(ValueError):
+            limiter.call(fn)
+        self.assertEqual((fn.calls, limiter.retries, limiter.throttled, limiter.in_flight), (1, 0, 0, 0))
+
+    def test_transient_errors_are_retried_without_lowering_the_limit(self):
+        limiter, fn = scheduler(max_concurrency=4), Failing(TimeoutError("read timed out"))
+        self.assertEqual(limiter.call(fn), "ok")
+        self.assertEqual((fn.calls, limiter.retries, limiter.throttled, limiter.limit), (2, 1, 0, 4.0))
+
+    def test_retries_are_bounded(self):
+        limiter, fn = scheduler(max_retries=2), Failing(*[Throttled(1) for _ in range(5)])
+        with self.assertRaises(Throttled):
+            limiter.call(fn)
+        self.assertEqual((fn.calls, limiter.retries, limiter.in_flight), (3, 2, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()